@@ -0,0 +1,85 @@
+import asyncio
+import heapq
+from datetime import datetime, timedelta
+from typing import Optional, Callable, Awaitable, List
+
+from config import config
+from models import Permission
+from utils.metrics import register_gauge
+from utils.values import now
+
+# (end_time, permission id), stale entries are filtered out by sync_permissions
+heap: List[tuple[datetime, int]] = []
+task: Optional[asyncio.Task] = None
+wakeup: Optional[asyncio.Event] = None
+
+register_gauge('expiry.scheduled', lambda: len(heap))
+
+
+def schedule(permission_id: int, end_time: datetime):
+    """
+    在 end_time 撤销临时权限
+    """
+    earliest = heap[0][0] if heap else None
+    heapq.heappush(heap, (end_time, permission_id))
+    if wakeup is not None and (earliest is None or end_time < earliest):
+        wakeup.set()
+
+
+async def load():
+    """
+    加载所有未到期的临时权限，由 leader 调用
+    """
+    permissions = await Permission.filter(synced=False, name__startswith='ban_').values_list('id', 'end_time')
+    # called again whenever the lease is regained, keep one entry per permission
+    scheduled = {id: end_time for end_time, id in heap}
+    scheduled.update(permissions)
+    heap[:] = [(end_time, id) for id, end_time in scheduled.items()]
+    heapq.heapify(heap)
+    if wakeup is not None:
+        wakeup.set()
+
+
+async def run(revoke: Callable[[List[int]], Awaitable]):
+    while True:
+        wakeup.clear()
+        timeout = None
+        if heap:
+            timeout = (heap[0][0] - now()).total_seconds()
+        if timeout is None or timeout > 0:
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        due = []
+        current = now()
+        while heap and heap[0][0] <= current:
+            due.append(heapq.heappop(heap)[1])
+        try:
+            await revoke(due)
+        except Exception as e:
+            print(f'revoke expired permissions {due} failed: {e}')
+        # retry the ones failed to sync later
+        failed = await Permission.filter(id__in=due, synced=False, end_time__lte=current).values_list('id', flat=True)
+        for id in failed:
+            schedule(id, current + timedelta(seconds=config.expiry_retry_delay))
+
+
+async def start(revoke: Callable[[List[int]], Awaitable]):
+    """
+    Args:
+        revoke: revoke the expired permissions of given ids
+    """
+    global task, wakeup
+    if task is None:
+        wakeup = asyncio.Event()
+        task = asyncio.create_task(run(revoke))
+
+
+async def stop():
+    global task
+    if task is not None:
+        task.cancel()
+        task = None
@@ -1,15 +1,21 @@
+import time
 from datetime import timedelta
-from typing import List
+from typing import List, Optional
 
 import tortoise.exceptions
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Response
+from starlette.responses import StreamingResponse
+from tortoise.transactions import in_transaction
 
+from admin import expiry
 from admin.serializers import PermissionAdd, PermissionModel, PageModel, PermissionDelete
-from models import User, Permission
-from utils import kong
+from config import config
+from models import User, Permission, UserRole
+from utils import outbox
 from utils.common import get_user, get_user_id
 from utils.exceptions import Forbidden
-from utils.orm import get_object_or_404
+from utils.metrics import get_metric, register_gauge
+from utils.orm import get_object_or_404, paginate, export_ndjson
 from utils.values import now
 
 router = APIRouter(tags=['permission'])
@@ -23,45 +29,54 @@ def log(name: str, action: str, to: User, by: User, reason: str):
 @router.post('/users/{user_id}/permissions')
 async def add_permission(user_id: int, body: PermissionAdd, from_user: User = Depends(get_user)):
     to_user = await get_object_or_404(User, id=user_id)
-    await kong.add_acl(user_id, body.name)
     if body.name not in to_user.roles:
         to_user.roles.append(body.name)
 
-    # permissions with time limit
-    if body.name.startswith('ban_'):
-        permission = await Permission.get_or_none(user_id=user_id, name=body.name)
-        # permissions that should add offense count
-        to_user.offense_count += 1
+    async with in_transaction() as connection:
+        await outbox.enqueue(user_id, body.name, 'add', using_db=connection)
+
+        # permissions with time limit
+        if body.name.startswith('ban_'):
+            permission = await Permission.get_or_none(user_id=user_id, name=body.name).using_db(connection)
+            # permissions that should add offense count
+            to_user.offense_count += 1
+
+            if permission:
+                if permission.synced:
+                    # if not banned, start from now
+                    permission.start_time = now()
+                    permission.end_time = now() + timedelta(days=body.days)
+                    permission.synced = False
+                else:
+                    # if is banned, accumulate
+                    permission.end_time += timedelta(days=body.days)
+
+                # accumulate reasons
+                permission.reason += f'\n{body.reason}'
+                permission.made_by = from_user
+                try:
+                    await permission.save(using_db=connection)
+                # reason maybe longer than 100
+                except tortoise.exceptions.ValidationError:
+                    permission.reason = f'{body.reason}'
+                    await permission.save(using_db=connection)
 
-        if permission:
-            if permission.synced:
-                # if not banned, start from now
-                permission.start_time = now()
-                permission.end_time = now() + timedelta(days=body.days)
-                permission.synced = False
             else:
-                # if is banned, accumulate
-                permission.end_time += timedelta(days=body.days)
-
-            # accumulate reasons
-            permission.reason += f'\n{body.reason}'
-            permission.made_by = from_user
-            try:
-                await permission.save()
-            # reason maybe longer than 100
-            except tortoise.exceptions.ValidationError:
-                permission.reason = f'{body.reason}'
-                await permission.save()
-
-        else:
-            await Permission.create(
-                user=to_user,
-                made_by=from_user,
-                name=body.name,
-                end_time=now() + timedelta(days=body.days),
-                reason=body.reason
-            )
-    await to_user.save()
+                permission = await Permission.create(
+                    user=to_user,
+                    made_by=from_user,
+                    name=body.name,
+                    end_time=now() + timedelta(days=body.days),
+                    reason=body.reason,
+                    using_db=connection
+                )
+        await to_user.save(using_db=connection)
+        await UserRole.sync([to_user], using_db=connection)
+    # a concurrent read may have cached the user again before commit
+    await User.invalidate_cache(user_id)
+    outbox.notify()
+    if body.name.startswith('ban_'):
+        expiry.schedule(permission.id, permission.end_time)
     log(body.name, 'ADD', to_user, from_user, body.reason)
     return {'message': 'success'}
 
@@ -70,17 +85,21 @@ async def add_permission(user_id: int, body: PermissionAdd, from_user: User = De
 @router.delete('/users/{user_id}/permissions/{name}')
 async def delete_permission(user_id: int, name: str, body: PermissionDelete, from_user: User = Depends(get_user)):
     to_user = await get_object_or_404(User, id=user_id)
-    permission = await Permission.get_or_none(user_id=user_id, name=name)
-    if permission:
-        permission.synced = True
-        await permission.save()
-
-    await kong.delete_acl(user_id, name)
-    try:
-        to_user.roles.remove(name)
-        await to_user.save()
-    except ValueError:
-        pass
+    async with in_transaction() as connection:
+        permission = await Permission.get_or_none(user_id=user_id, name=name).using_db(connection)
+        if permission:
+            permission.synced = True
+            await permission.save(using_db=connection)
+
+        await outbox.enqueue(user_id, name, 'delete', using_db=connection)
+        try:
+            to_user.roles.remove(name)
+            await to_user.save(using_db=connection)
+            await UserRole.sync([to_user], using_db=connection)
+        except ValueError:
+            pass
+    await User.invalidate_cache(user_id)
+    outbox.notify()
     log(name, 'DELETE', to_user, from_user, body.reason)
     return {'message': 'success'}
 
@@ -94,6 +113,16 @@ async def list_permissions_by_user(user_id: int, request_user_id: int = Depends(
     return permissions
 
 
+# admin only, must be declared before /permissions/{id}
+@router.get('/permissions/export')
+async def export_permissions():
+    fields = ('id', 'user_id', 'made_by_id', 'name', 'reason', 'start_time', 'end_time', 'synced')
+    return StreamingResponse(
+        export_ndjson(Permission.all(), fields, config.export_chunk_size),
+        media_type='application/x-ndjson'
+    )
+
+
 # admin only
 @router.get('/permissions/{id}', response_model=PermissionModel)
 async def get_permission_by_id(id: int):
@@ -103,23 +132,69 @@ async def get_permission_by_id(id: int):
 
 # admin only
 @router.get('/permissions', response_model=List[PermissionModel])
-async def list_permissions(query: PageModel = Depends()):
-    permissions = await Permission.all().offset(query.offset).limit(query.size)
+async def list_permissions(response: Response, query: PageModel = Depends()):
+    permissions = await paginate(
+        Permission.all(), response, query.size, query.cursor, query.offset,
+        ordering=('end_time', 'id')
+    )
     return permissions
 
 
-async def sync_permissions():
-    permissions = await Permission.filter(synced=False, end_time__lt=now())
-    for permission in permissions:
-        await kong.delete_acl(permission.user_id, permission.name)
-        permission.synced = True
-        await permission.save()
-
-        # save user status
-        user = await User.get_or_none(id=permission.user_id)
-        if user is not None:
-            try:
-                user.roles.remove(permission.name)
-                await user.save()
-            except ValueError:
-                pass
+# total of all runs
+sync_status = {'processed': 0}
+register_gauge('sync_permissions.processed', lambda: sync_status['processed'])
+
+
+async def sync_permissions(ids: Optional[List[int]] = None) -> int:
+    """
+    撤销已到期的临时权限，按 id 分批处理，返回撤销的条数
+    网关的 acl 经 outbox 删除，同时覆盖尚未发送的添加
+    """
+    processed = 0
+    last_id = 0
+    while True:
+        start = time.monotonic()
+        queryset = Permission.filter(synced=False, end_time__lt=now(), id__gt=last_id)
+        if ids is not None:
+            queryset = queryset.filter(id__in=ids)
+        chunk = await queryset.order_by('id').limit(config.sync_chunk_size).values_list('id', flat=True)
+        if not chunk:
+            break
+        last_id = chunk[-1]
+
+        changed_users = {}
+        async with in_transaction() as connection:
+            # checked again and locked, so that permissions and roles changed meanwhile are not overwritten
+            permissions = await Permission.filter(
+                id__in=chunk, synced=False, end_time__lt=now()
+            ).select_for_update().using_db(connection)
+            users = await User.filter(
+                id__in={p.user_id for p in permissions}
+            ).select_for_update().using_db(connection)
+            users = {user.id: user for user in users}
+            for permission in permissions:
+                permission.synced = True
+                # save user status
+                user = users.get(permission.user_id)
+                if user is not None and permission.name in user.roles:
+                    user.roles.remove(permission.name)
+                    changed_users[user.id] = user
+            if permissions:
+                await outbox.enqueue_many(
+                    [(p.user_id, p.name, 'delete') for p in permissions], using_db=connection
+                )
+                await Permission.all().using_db(connection).bulk_update(permissions, fields=['synced'])
+            if changed_users:
+                await User.all().using_db(connection).bulk_update(list(changed_users.values()), fields=['roles'])
+                await UserRole.sync(changed_users.values(), using_db=connection)
+        if changed_users:
+            await User.invalidate_cache(*changed_users)
+        if permissions:
+            outbox.notify()
+
+        processed += len(permissions)
+        sync_status['processed'] += len(permissions)
+        get_metric('sync_permissions.chunk').observe(time.monotonic() - start)
+        if len(chunk) < config.sync_chunk_size:
+            break
+    return processed
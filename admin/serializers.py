@@ -1,6 +1,6 @@
 from typing import Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 
 from config import config
 from models import Permission, User
@@ -27,13 +27,24 @@ class PermissionAdd(PermissionDelete):
 
 class PageModel(BaseModel):
     size: Optional[int] = config.default_size
-    offset: Optional[int] = 0
+    offset: Optional[int] = 0  # deprecated, use cursor
+    cursor: Optional[str]  # from the X-Next-Cursor header of the previous page
+
+    @validator('size', always=True)
+    def limit_size(cls, v):
+        if v is None or v <= 0 or v > config.max_page_size:
+            return config.max_page_size
+        return v
 
 
 class UserGet(PageModel):
     role: Optional[str]
 
 
+class UserExport(BaseModel):
+    role: Optional[str]
+
+
 class UserModify(BaseModel):
     nickname: Optional[str]
     permission: dict
@@ -1,13 +1,17 @@
 from typing import List
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Response
+from starlette.responses import StreamingResponse
 from fastapi.params import Depends
+from tortoise.expressions import Subquery
+from tortoise.queryset import QuerySet
 
-from admin.serializers import UserModel, UserModify, UserGet
-from models import User
+from admin.serializers import UserModel, UserModify, UserGet, UserExport
+from config import config
+from models import User, UserRole
 from utils.common import get_user
-from utils.exceptions import Forbidden
-from utils.orm import get_object_or_404
+from utils.exceptions import Forbidden, NotFound
+from utils.orm import get_object_or_404, paginate, export_ndjson
 
 router = APIRouter(tags=['user'])
 
@@ -17,27 +21,39 @@ async def get_current_user(user: User = Depends(get_user)):
     return preprocess(user)
 
 
+# admin only, must be declared before /users/{user_id}
+@router.get('/users/export')
+async def export_users(query: UserExport = Depends()):
+    if query.role:
+        queryset = User.filter(id__in=Subquery(role_filter(query.role).values('user_id')))
+    else:
+        queryset = User.all()
+    fields = ('id', 'nickname', 'joined_time', 'last_login', 'roles', 'offense_count', 'is_admin', 'config')
+    return StreamingResponse(
+        export_ndjson(queryset, fields, config.export_chunk_size),
+        media_type='application/x-ndjson'
+    )
+
+
 # owner or admin
 @router.get('/users/{user_id}', response_model=UserModel)
 async def get_user_by_id(user_id: int, user: User = Depends(get_user)):
     if not user.id == user_id:
         raise Forbidden()
-    user = await get_object_or_404(User, id=user_id)
+    user = await User.get_cached(user_id)
+    if not user:
+        raise NotFound('User does not exist')
     return preprocess(user)
 
 
 # admin only
 @router.get('/users', response_model=List[UserModel])
-async def list_users(query: UserGet = Depends()):
+async def list_users(response: Response, query: UserGet = Depends()):
     if query.role:
-        queryset = User.filter(roles__contains=[query.role])
+        queryset = User.filter(id__in=Subquery(role_filter(query.role).values('user_id')))
     else:
         queryset = User.all()
-    if query.size != 0:
-        queryset = queryset.limit(query.size)
-    queryset = queryset.offset(query.offset)
-
-    users = await queryset
+    users = await paginate(queryset, response, query.size, query.cursor, query.offset)
     return preprocess_many(users)
 
 
@@ -50,6 +66,17 @@ async def modify_user(user_id: int, body: UserModify):
     return preprocess(user)
 
 
+def role_filter(role: str) -> QuerySet[UserRole]:
+    """
+    按角色筛选，以 * 结尾时按前缀筛选，如 ban_*
+    """
+    if role.endswith('*') and len(role) > 1:
+        # range query instead of LIKE so that the index is used
+        prefix = role[:-1]
+        return UserRole.filter(role__gte=prefix, role__lt=prefix[:-1] + chr(ord(prefix[-1]) + 1))
+    return UserRole.filter(role=role)
+
+
 def preprocess(user: User) -> User:
     user.user_id = user.id
     user.favorites = []
@@ -1,3 +1,5 @@
+import asyncio
+
 from fastapi import APIRouter, Depends
 from pydantic import ValidationError
 from starlette.responses import JSONResponse
@@ -5,14 +7,15 @@ from starlette.responses import JSONResponse
 from auth.response import EmailVerifyResponse, APIKeyVerifyResponse, TokensResponse
 from auth.serializers import EmailModel, ApikeyVerifyModel, RegisterModel, LoginModel
 from config import config
-from models import User, RegisteredEmail, DeletedEmail
-from utils.auth import make_identifier, set_verification_code, check_api_key, check_verification_code, \
-    delete_verification_code, make_password, check_password
-from utils.common import send_email, get_user
-from utils.exceptions import BadRequest, Forbidden
+from models import User, RegisteredEmail, get_email_status
+from utils.auth import set_verification_code, check_api_key, check_verification_code, \
+    delete_verification_code
+from utils.common import send_email, get_user_from_db
+from utils.exceptions import BadRequest, Forbidden, NotFound
 from utils.jwt_utils import create_tokens
 from utils.kong import delete_jwt_credentials
-from utils.orm import get_object_or_404
+from utils.password import make_password, check_password
+from utils.revocation import revoke_tokens
 
 router = APIRouter(tags=['account'])
 
@@ -76,15 +79,14 @@ async def verify_with_apikey(query: ApikeyVerifyModel = Depends()):
 async def register(body: RegisterModel):
     if not await check_verification_code(body.email, body.verification, 'register'):
         raise BadRequest('验证码错误')
-    registered = await RegisteredEmail.has_email(body.email)
-    deleted = await DeletedEmail.has_email(body.email)
+    registered, deleted = await get_email_status(body.email)
     if registered:
         if not deleted:
             raise BadRequest('该用户已注册，如果忘记密码，请使用忘记密码功能找回')
         else:
-            user = await User.all_objects.filter(identifier=make_identifier(body.email)).first()
+            user = await User.get_by_email(body.email, include_inactive=True)
             user.is_active = True
-            user.password = make_password(body.password)
+            user.password = await make_password(body.password)
             await user.save()
     else:
         user = await User.create_user(email=body.email, password=body.password)
@@ -100,19 +102,24 @@ async def change_password(body: RegisterModel):
     """
     if not await check_verification_code(body.email, body.verification, 'reset'):
         raise BadRequest('验证码错误')
-    user = await get_object_or_404(User, identifier=make_identifier(body.email))
-    user.password = make_password(body.password)
+    user = await User.get_by_email(body.email)
+    if not user:
+        raise NotFound('User does not exist')
+    user.password = await make_password(body.password)
     await user.save()
-    await delete_jwt_credentials(user.id)
+    await asyncio.gather(
+        delete_jwt_credentials(user.id),
+        revoke_tokens(user.id)
+    )
     access_token, refresh_token = await create_tokens(user)
     await delete_verification_code(body.email, 'reset')
     return {'access': access_token, 'refresh': refresh_token, 'message': 'reset password successful'}
 
 
 @router.delete('/users/me', status_code=204)
-async def delete_user(body: LoginModel, user: User = Depends(get_user)):
+async def delete_user(body: LoginModel, user: User = Depends(get_user_from_db)):
     # TODO: safe password
-    if not check_password(body.password, user.password):
+    if not await check_password(body.password, user.password):
         raise Forbidden('password incorrect')
     # TODO: verify email
     await user.delete_user(body.email)
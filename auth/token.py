@@ -1,16 +1,20 @@
+import asyncio
+
 from fastapi import APIRouter, Depends
 
-import shamir.gpg
 from auth.response import TokensResponse, MessageResponse
 from auth.serializers import LoginModel
+from config import config
 from models import User
-from utils.auth import make_identifier, check_password
+from utils.auth import password_must_update
 from utils.common import get_user, get_user_by_refresh_token
-from utils.exceptions import Unauthorized
+from utils.exceptions import Unauthorized, NotFound
 from utils.jwt_utils import create_tokens
+from utils.keyring import keyring
 from utils.kong import delete_jwt_credentials
-from utils.orm import get_object_or_404
-from shamir import ShamirEmail
+from utils.password import check_password, make_password
+from utils.revocation import revoke_tokens
+from shamir import ShamirEmail, escrow
 
 router = APIRouter(tags=['token'])
 
@@ -23,23 +27,40 @@ async def login_required(user: User = Depends(get_user)):
 @router.post('/login', response_model=TokensResponse)
 async def login(body: LoginModel):
     # TODO: login v2
-    user = await get_object_or_404(User, identifier=make_identifier(body.email))
-    if not check_password(body.password, user.password):
+    user = await User.get_by_email(body.email)
+    if not user:
+        raise NotFound('User does not exist')
+    if not await check_password(body.password, user.password):
         raise Unauthorized('password incorrect')
-    shamir_info = await ShamirEmail.filter(user_id=user.id)
-    if len(shamir_info) == 0:
-        await shamir.gpg.encrypt_email(body.email, user.id)
+    if password_must_update(user.password):
+        user.password = await make_password(body.password)
+        await user.save(update_fields=['password'])
+    if not await ShamirEmail.filter(user_id=user.id).exists():
+        escrow.enqueue(body.email, user.id)
     access_token, refresh_token = await create_tokens(user)
     return {'access': access_token, 'refresh': refresh_token, 'message': 'login successful'}
 
 
 @router.get('/logout', response_model=MessageResponse)
 async def logout(user: User = Depends(get_user)):
-    await delete_jwt_credentials(user.id)
+    await asyncio.gather(
+        delete_jwt_credentials(user.id),
+        revoke_tokens(user.id)
+    )
     return {'message': 'logout successful'}
 
 
+@router.get('/.well-known/jwks.json')
+async def jwks():
+    """
+    本地签名模式下的公钥
+    """
+    if config.jwt_mode != 'local':
+        return {'keys': []}
+    return keyring.jwks()
+
+
 @router.post('/refresh', response_model=TokensResponse)
 async def refresh(user: User = Depends(get_user_by_refresh_token)):
-    access_token, refresh_token = await create_tokens(user)
+    access_token, refresh_token = await create_tokens(user, refresh=True)
     return {'access': access_token, 'refresh': refresh_token, 'message': 'refresh successful'}
@@ -47,6 +47,8 @@ class Settings(BaseSettings):
     db_url: str = 'sqlite://db.sqlite3'
     test_db: str = 'sqlite://:memory:'
     default_size: int = 10
+    max_page_size: int = 100
+    export_chunk_size: int = 1000
     site_name: str = 'Open Tree Hole'
     domain: str = 'fduhole.com'
     email_whitelist: List[str] = []
@@ -61,10 +63,61 @@ class Settings(BaseSettings):
     register_apikey_seed: str = ''
     kong_url: str = 'http://kong:8001'
     kong_token: str = ''
+    kong_pool_size: int = 100
+    kong_keepalive: float = 30
+    kong_timeout: float = 5  # deadline of a call including retries, seconds
+    kong_retries: int = 2
+    kong_retry_backoff: float = 0.1
+    kong_breaker_threshold: int = 5
+    kong_breaker_reset: float = 10
     authorize_in_debug: bool = True
     redis_url: str = 'redis://redis:6379'
     identifier_salt: str = str(base64.b64encode(b'123456'), 'utf-8')
+    identifier_iterations: int = 1
+    # iterations of identifiers not yet upgraded, still accepted when looking up users
+    identifier_legacy_iterations: List[int] = []
+    identifier_cache_size: int = 10000
     provision_key: str = ''
+    # kong: sign with per-user kong jwt credentials
+    # local: sign with the local key ring, verified by the gateway via /api/.well-known/jwks.json
+    jwt_mode: str = 'kong'
+    jwt_issuer: str = 'auth'
+    jwt_algorithm: str = 'RS256'  # RS256 or EdDSA, local mode only
+    jwt_key_path: str = 'data/jwt_keys'  # shared by all replicas, python -m utils.keyring rotate to provision
+    jwt_key_count: int = 3  # keys kept after rotation
+    lease_ttl: int = 30  # leader election of background jobs, seconds
+    lease_heartbeat: float = 10
+    sync_interval: int = 3600  # reconciliation of expired permissions, seconds
+    expiry_retry_delay: int = 60
+    sync_chunk_size: int = 500
+    outbox_batch_size: int = 100
+    outbox_concurrency: int = 10
+    outbox_interval: float = 1  # seconds between polls when idle
+    outbox_max_backoff: int = 300
+    escrow_workers: int = 2  # background shamir escrow of emails
+    gpg_backend: str = 'pgpy'  # pgpy (in process, falls back to gpg if unavailable) or gnupg (gpg subprocess)
+    gpg_workers: int = 8  # shares encrypted in parallel by gpg subprocesses
+    gpg_keys_ttl: int = 300  # seconds before reloading the gpg public keys, 0 to never reload
+    escrow_retries: int = 3
+    escrow_queue_size: int = 10000
+    last_login_flush_interval: float = 10  # seconds
+    last_login_batch_size: int = 500
+    credential_cache_size: int = 10000
+    credential_cache_ttl: int = 60  # in-process, only without redis, seconds
+    credential_cache_redis: bool = True
+    credential_cache_redis_ttl: int = 300
+    credential_missing_ttl: int = 10  # users without a credential, in-process, seconds
+    user_cache_size: int = 10000
+    user_cache_ttl: int = 10  # in-process, seconds
+    user_cache_redis: bool = True
+    user_cache_redis_ttl: int = 300
+    revocation_capacity: int = 100000
+    revocation_sync_interval: float = 1  # seconds
+    email_filter_capacity: int = 1000000
+    password_hasher: str = 'pbkdf2_sha256'
+    password_hasher_params: dict = {}  # python -m utils.hashers to calibrate
+    password_workers: int = 0  # 0 for cpu count
+    password_queue_size: int = 64
 
 
 config = Settings(tz=parse_tz())
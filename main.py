@@ -4,10 +4,18 @@ from starlette.responses import RedirectResponse
 
 app = FastAPI()  # app 实例化位于所有导入之前
 
-from admin import permission, user
+from admin import permission, user, expiry
 from auth import account, token
 
 import oauth2
+from config import config
+from models import RegisteredEmail, DeletedEmail
+from shamir import escrow
+from utils import password, outbox, last_login
+from utils.keyring import keyring
+from utils.kong_client import client as kong_client
+from utils.lease import leader
+from utils.metrics import snapshot
 
 app.include_router(account.router, prefix='/api')
 app.include_router(token.router, prefix='/api')
@@ -26,8 +34,46 @@ async def redirect_to_home():
     return RedirectResponse('/api')
 
 
+# admin only
+@app.get('/api/metrics')
+async def get_metrics():
+    return snapshot()
+
+
+async def sync_permissions_if_leader():
+    if leader.is_leader:
+        await permission.sync_permissions()
+
+
 @app.on_event('startup')
 async def start_up():
+    password.start()
+    if config.jwt_mode == 'local':
+        keyring.ensure(create=config.debug)
+    RegisteredEmail.start_bloom()
+    DeletedEmail.start_bloom()
+    await kong_client.start()
+    leader.on_elected.append(expiry.load)
+    leader.start()
+    outbox.start()
+    last_login.start()
+    escrow.start()
+    await expiry.start(permission.sync_permissions)
+    # safety net for the expiry timers
     scheduler = AsyncIOScheduler()
     scheduler.start()
-    scheduler.add_job(permission.sync_permissions, 'interval', seconds=3600)
+    scheduler.add_job(sync_permissions_if_leader, 'interval', seconds=config.sync_interval)
+
+
+async def shut_down():
+    password.shutdown()
+    await outbox.stop()
+    await last_login.stop()
+    await escrow.stop()
+    await expiry.stop()
+    await leader.stop()
+    await kong_client.close()
+
+
+# runs before the handler of register_tortoise closes the connections, so the pending writes can be flushed
+app.router.on_shutdown.insert(0, shut_down)
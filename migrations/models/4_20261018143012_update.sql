@@ -0,0 +1,13 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS `kong_outbox` (
+    `id` INT NOT NULL PRIMARY KEY AUTO_INCREMENT,
+    `consumer_id` INT NOT NULL,
+    `name` VARCHAR(32) NOT NULL,
+    `action` VARCHAR(8) NOT NULL,
+    `created_at` DATETIME(6) NOT NULL  DEFAULT CURRENT_TIMESTAMP(6),
+    `next_try` DATETIME(6) NOT NULL  DEFAULT CURRENT_TIMESTAMP(6),
+    `attempts` INT NOT NULL  DEFAULT 0,
+    KEY `idx_kong_ou_consume_4d1a5e` (`consumer_id`, `name`)
+) CHARACTER SET utf8mb4 COMMENT='ACL changes waiting to be synced to the API gateway';
+-- downgrade --
+DROP TABLE IF EXISTS `kong_outbox`;
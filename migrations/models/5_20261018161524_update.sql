@@ -0,0 +1,14 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS `user_role` (
+    `id` INT NOT NULL PRIMARY KEY AUTO_INCREMENT,
+    `role` VARCHAR(32) NOT NULL,
+    `user_id` INT NOT NULL,
+    UNIQUE KEY `uid_user_role_user_id_0b6b8e` (`user_id`, `role`),
+    KEY `idx_user_role_role_5f2f0e` (`role`),
+    CONSTRAINT `fk_user_rol_user_9b1b6c8e` FOREIGN KEY (`user_id`) REFERENCES `user` (`id`) ON DELETE CASCADE
+) CHARACTER SET utf8mb4 COMMENT='Normalized copy of User.roles, indexed for filtering users by role';
+INSERT IGNORE INTO `user_role` (`user_id`, `role`)
+    SELECT `user`.`id`, `roles`.`role` FROM `user`,
+    JSON_TABLE(`user`.`roles`, '$[*]' COLUMNS (`role` VARCHAR(32) PATH '$')) AS `roles`;
+-- downgrade --
+DROP TABLE IF EXISTS `user_role`;
@@ -0,0 +1,4 @@
+-- upgrade --
+ALTER TABLE `permission` ADD INDEX `idx_permission_end_tim_8c2a61` (`end_time`, `id`);
+-- downgrade --
+ALTER TABLE `permission` DROP INDEX `idx_permission_end_tim_8c2a61`;
@@ -0,0 +1,6 @@
+-- upgrade --
+ALTER TABLE `shamir_email` ADD `data` LONGBLOB;
+ALTER TABLE `shamir_email` MODIFY COLUMN `key` LONGTEXT;
+-- downgrade --
+ALTER TABLE `shamir_email` DROP COLUMN `data`;
+ALTER TABLE `shamir_email` MODIFY COLUMN `key` LONGTEXT NOT NULL;
@@ -1,13 +1,25 @@
 import asyncio
+import json
+from collections import defaultdict
+from datetime import datetime
+from typing import Iterable, Optional, Tuple
 
 from tortoise import fields
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.expressions import Subquery
 from tortoise.manager import Manager
 from tortoise.models import Model
 
-import shamir.gpg
+from shamir import escrow
+from config import config
 from utils import kong
-from utils.auth import make_identifier, make_password, sha3
+from utils.auth import make_identifier, sha3, identifier_candidates
+from utils.bloom import SharedBloomFilter
+from utils.cache import cache, LRUCache
 from utils.kong import delete_jwt_credentials
+from utils.metrics import register_gauge
+from utils.password import make_password
+from utils.revocation import revoke_tokens
 
 
 class IsActiveManager(Manager):
@@ -15,6 +27,41 @@ class IsActiveManager(Manager):
         return super().get_queryset().filter(is_active=True)
 
 
+class UserSnapshot:
+    """
+    缓存中的用户，只包含常用的字段，JSON 字段以字符串保存
+    """
+    __slots__ = ('id', 'nickname', 'is_active', 'is_admin', 'joined_time', 'last_login', 'offense_count', 'roles',
+                 'config')
+    json_fields = ('roles', 'config')
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    @classmethod
+    def from_user(cls, user: 'User') -> 'UserSnapshot':
+        return cls(*[
+            json.dumps(getattr(user, field)) if field in cls.json_fields else getattr(user, field)
+            for field in cls.__slots__
+        ])
+
+    def to_list(self) -> list:
+        """
+        json serializable, for the shared cache
+        """
+        values = [getattr(self, field) for field in self.__slots__]
+        return [v.isoformat() if isinstance(v, datetime) else v for v in values]
+
+    def to_user(self) -> 'User':
+        # a new partial instance each time, saving it without update_fields raises IncompleteInstanceError
+        return User._init_from_db(**{field: getattr(self, field) for field in self.__slots__})
+
+
+user_cache = LRUCache(config.user_cache_size, config.user_cache_ttl)
+register_gauge('user_cache.size', lambda: len(user_cache))
+
+
 class User(Model):
     id = fields.IntField(pk=True)
     email = fields.CharField(max_length=1000)  # deprecated
@@ -33,6 +80,7 @@ class User(Model):
     favorites: list[int]  # old api
     permissions: fields.ReverseRelation['Permission']
     permissions_made: fields.ReverseRelation['Permission']
+    user_roles: fields.ReverseRelation['UserRole']
     all_objects = Manager()
 
     def __str__(self):
@@ -49,17 +97,69 @@ class User(Model):
         allow_cycles = False
         max_recursion = 1
 
+    async def save(self, *args, **kwargs):
+        await super().save(*args, **kwargs)
+        await User.invalidate_cache(self.id)
+
+    @classmethod
+    async def get_cached(cls, id: int) -> Optional['User']:
+        """
+        读取缓存的用户，只包含 UserSnapshot 中的字段，用于只读的场景
+        """
+        snapshot = user_cache.get(id)
+        if snapshot is None and config.user_cache_redis:
+            values = await cache.get(str(id), namespace='user')
+            if values is not None:
+                snapshot = UserSnapshot(*values)
+                user_cache.set(id, snapshot)
+        if snapshot is not None:
+            return snapshot.to_user()
+
+        user = await cls.get_or_none(id=id)
+        if user is None:
+            return None
+        snapshot = UserSnapshot.from_user(user)
+        user_cache.set(id, snapshot)
+        if config.user_cache_redis:
+            await cache.set(str(id), snapshot.to_list(), ttl=config.user_cache_redis_ttl, namespace='user')
+        return user
+
+    @classmethod
+    async def invalidate_cache(cls, *ids: int):
+        """
+        其他进程的进程内缓存在 user_cache_ttl 后过期
+        """
+        for id in ids:
+            user_cache.delete(id)
+        if config.user_cache_redis:
+            await asyncio.gather(*[cache.delete(str(id), namespace='user') for id in ids])
+
+    @classmethod
+    async def get_by_email(cls, email: str, include_inactive: bool = False) -> Optional['User']:
+        """
+        按邮箱查找用户，找到旧迭代次数生成的 identifier 时升级
+        """
+        identifiers = identifier_candidates(email)
+        queryset = cls.all_objects.filter(identifier__in=identifiers)
+        if not include_inactive:
+            queryset = queryset.filter(is_active=True)
+        user = await queryset.first()
+        if user and user.identifier != identifiers[0]:
+            user.identifier = identifiers[0]
+            await user.save(update_fields=['identifier'])
+        return user
+
     @classmethod
     async def create_user(cls, email: str, password: str, **kwargs) -> 'User':
         user = await cls.create(
             email='',
             identifier=make_identifier(email),
-            password=make_password(password),
+            password=await make_password(password),
             **kwargs
         )
+        escrow.enqueue(email, user.id)
         await asyncio.gather(
             RegisteredEmail.add(email),
-            shamir.gpg.encrypt_email(email, user.id),
             kong.create_user(user.id)
         )
         return user
@@ -69,6 +169,7 @@ class User(Model):
         await asyncio.gather(
             self.save(),
             delete_jwt_credentials(self.id),
+            revoke_tokens(self.id),
             DeletedEmail.add(email)
         )
 
@@ -92,32 +193,163 @@ class Permission(Model):
     end_time = fields.DatetimeField(auto_now_add=True)
     synced = fields.BooleanField(default=False)  # has synced to API gateway
 
+    class Meta:
+        indexes = (('end_time', 'id'),)
+
     class PydanticMeta:
         exclude = []
         allow_cycles = False
         max_recursion = 1
 
 
+class UserRole(Model):
+    """
+    Normalized copy of User.roles, indexed for filtering users by role
+    """
+    id = fields.IntField(pk=True)
+    user: fields.ForeignKeyRelation['User'] = fields.ForeignKeyField('models.User', related_name='user_roles')
+    user_id: int
+    role = fields.CharField(max_length=32, index=True)
+
+    class Meta:
+        table = 'user_role'
+        unique_together = (('user', 'role'),)
+
+    @classmethod
+    async def sync(cls, users: Iterable[User], using_db: Optional[BaseDBAsyncClient] = None):
+        """
+        按 User.roles 更新 user_role 表，只写入有变化的行
+        """
+        users = list(users)
+        if not users:
+            return
+        existing = set(await cls.filter(user_id__in=[user.id for user in users]).using_db(using_db).values_list(
+            'user_id', 'role'
+        ))
+        expected = {(user.id, role) for user in users for role in user.roles}
+
+        removed = defaultdict(list)
+        for user_id, role in existing - expected:
+            removed[role].append(user_id)
+        for role, user_ids in removed.items():
+            await cls.filter(role=role, user_id__in=user_ids).using_db(using_db).delete()
+
+        added = expected - existing
+        if added:
+            await cls.all().using_db(using_db).bulk_create(
+                [cls(user_id=user_id, role=role) for user_id, role in added],
+                ignore_conflicts=True
+            )
+
+
+class KongOutbox(Model):
+    """
+    ACL changes waiting to be synced to the API gateway
+    """
+    id = fields.IntField(pk=True)
+    consumer_id = fields.IntField()
+    name = fields.CharField(max_length=32)
+    action = fields.CharField(max_length=8)  # add or delete
+    created_at = fields.DatetimeField(auto_now_add=True)
+    next_try = fields.DatetimeField(auto_now_add=True)
+    attempts = fields.IntField(default=0)
+
+    class Meta:
+        table = 'kong_outbox'
+        indexes = (('consumer_id', 'name'),)
+
+
 class EmailList(Model):
     hash = fields.CharField(max_length=128, pk=True)
+    # definite negatives without querying, only used after loaded from the database
+    bloom: SharedBloomFilter
+    bloom_ready = False
+    bloom_task: Optional[asyncio.Task] = None
 
     @classmethod
     async def has_email(cls, email: str) -> bool:
-        return await cls.filter(hash=sha3(email)).exists()
+        return await cls.has_hash(sha3(email))
+
+    @classmethod
+    async def has_hash(cls, hash: str) -> bool:
+        if not await cls.might_have(hash):
+            return False
+        return await cls.filter(hash=hash).exists()
+
+    @classmethod
+    async def might_have(cls, hash: str) -> bool:
+        return not cls.bloom_ready or await cls.bloom.might_contain(hash)
 
     @classmethod
     async def add(cls, email: str):
-        await cls.create(hash=sha3(email))
+        hash = sha3(email)
+        await cls.create(hash=hash)
+        await cls.bloom.add(hash)
+
+    @classmethod
+    async def load_bloom(cls, chunk_size: int = 10000):
+        # emails added after this are read from the log of the shared filter
+        cls.bloom.reset(await cls.bloom.current_seq())
+        last = ''
+        while True:
+            hashes = await cls.filter(hash__gt=last).order_by('hash').limit(chunk_size).values_list('hash', flat=True)
+            for hash in hashes:
+                cls.bloom.local.add(hash)
+            if len(hashes) < chunk_size:
+                break
+            last = hashes[-1]
+        cls.bloom_ready = True
+        print(f'{cls.__name__} bloom filter loaded')
+
+    @classmethod
+    async def _load_bloom(cls):
+        try:
+            await cls.load_bloom()
+        except Exception as e:
+            print(f'load {cls.__name__} bloom filter failed: {e}')
+
+    @classmethod
+    def start_bloom(cls):
+        """
+        在后台加载布隆过滤器，加载完成前直接查询数据库
+        """
+        async def rebuild():
+            cls.start_bloom()
+
+        cls.bloom_ready = False
+        cls.bloom.on_lost = rebuild
+        cls.bloom_task = asyncio.create_task(cls._load_bloom())
 
     class Meta:
         abstract = True
 
 
 class RegisteredEmail(EmailList):
+    bloom = SharedBloomFilter('registered-emails', config.email_filter_capacity, sync_interval=0)
+
     class Meta:
         table = "registered_email"
 
 
 class DeletedEmail(EmailList):
+    bloom = SharedBloomFilter('deleted-emails', config.email_filter_capacity, sync_interval=0)
+
     class Meta:
         table = "deleted_email"
+
+
+async def get_email_status(email: str) -> Tuple[bool, bool]:
+    """
+    Returns:
+        registered, deleted
+    """
+    hash = sha3(email)
+    if not await RegisteredEmail.might_have(hash):
+        return False, False
+    # deleted emails are always registered, one query for both
+    rows = await RegisteredEmail.filter(hash=hash).annotate(
+        deleted=Subquery(DeletedEmail.filter(hash=hash).values('hash'))
+    ).limit(1).values('deleted')
+    if not rows:
+        return False, False
+    return True, rows[0]['deleted'] is not None
@@ -4,8 +4,7 @@ from fastapi import Header, Depends
 from config import config
 from models import User
 from oauth2 import router
-from utils.exceptions import Unauthorized
-from utils.orm import get_object_or_404
+from utils.exceptions import Unauthorized, NotFound
 
 
 def get_user_id_by_oauth2(x_authenticated_userid: str = Header(default='')):
@@ -23,7 +22,9 @@ async def oauth_me(
         id: int = Depends(get_user_id_by_oauth2),
         x_authenticated_scope: str = Header(default='id nickname')
 ):
-    user = await get_object_or_404(User, id=id)
+    user = await User.get_cached(id)
+    if not user:
+        raise NotFound('User does not exist')
     scopes = x_authenticated_scope.strip().split(' ')
     response = {}
     if 'email' in scopes:
@@ -1,14 +1,13 @@
 from tortoise import Model, fields
 
-import models
-
 
 class ShamirEmail(Model):
     """
     shamir secret sharing(SSS) shares of user email
     """
     id = fields.IntField(pk=True)
-    key = fields.TextField()
+    key = fields.TextField(null=True)  # deprecated, ascii armored text share
+    data = fields.BinaryField(null=True)  # binary pgp message of a binary share record
     user: fields.ForeignKeyRelation['models.User'] = fields.ForeignKeyField('models.User', related_name='shamir_emails')
     encrypted_by = fields.CharField(max_length=128)
 
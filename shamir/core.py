@@ -1,12 +1,25 @@
 import argparse
+import functools
+import hashlib
 import secrets
+from typing import Optional, Sequence
 
 # the 13th Mersenne prime
 P = 2 ** 521 - 1
 MAX_LENGTH = 64
+# binary share: 4 bytes x, 66 bytes y, big endian
+X_SIZE = 4
+Y_SIZE = (P.bit_length() + 7) // 8
+SHARE_SIZE = X_SIZE + Y_SIZE
+# versioned share record: 1 byte version, share, 4 bytes sha256 checksum
+VERSION = 1
+CHECKSUM_SIZE = 4
+RECORD_SIZE = 1 + SHARE_SIZE + CHECKSUM_SIZE
 
 
 class Share:
+    __slots__ = ('x', 'y')
+
     def __init__(self, x: int, y: int):
         self.x = x
         self.y = y
@@ -14,6 +27,30 @@ class Share:
     def __str__(self):
         return f'{self.x}\n{self.y}'
 
+    def to_bytes(self) -> bytes:
+        """
+        only shares with 32-bit x, e.g. from holder_x, could be encoded
+        """
+        return self.x.to_bytes(X_SIZE, 'big') + self.y.to_bytes(Y_SIZE, 'big')
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Share':
+        if len(data) != SHARE_SIZE:
+            raise ValueError(f'share should be {SHARE_SIZE} bytes')
+        return cls(x=int.from_bytes(data[:X_SIZE], 'big'), y=int.from_bytes(data[X_SIZE:], 'big'))
+
+    def pack(self) -> bytes:
+        body = bytes([VERSION]) + self.to_bytes()
+        return body + hashlib.sha256(body).digest()[:CHECKSUM_SIZE]
+
+    @classmethod
+    def unpack(cls, data: bytes) -> 'Share':
+        if len(data) != RECORD_SIZE or data[0] != VERSION:
+            raise ValueError('unknown share format')
+        if hashlib.sha256(data[:-CHECKSUM_SIZE]).digest()[:CHECKSUM_SIZE] != data[-CHECKSUM_SIZE:]:
+            raise ValueError('share checksum mismatch')
+        return cls.from_bytes(data[1:-CHECKSUM_SIZE])
+
 
 Shares = list[Share]
 
@@ -23,91 +60,159 @@ def modular_multiplicative_inverse(x: int, p: int = P) -> int:
     division in integers modulus p means finding the inverse of the denominator
     modulo p and then multiplying the numerator by this inverse
     (Note: inverse of A is B such that A*B % p == 1)
-    this can be computed via extended euclidean algorithm
-    https://en.wikipedia.org/wiki/Modular_multiplicative_inverse#Computation
     """
+    return pow(x, -1, p)
 
-    def extended_gcd(a: int, b: int) -> (int, int):
-        x = 0
-        last_x = 1
-        y = 1
-        last_y = 0
-        while b != 0:
-            quot = a // b
-            a, b = b, a % b
-            x, last_x = last_x - quot * x, x
-            y, last_y = last_y - quot * y, y
-        return last_x, last_y
 
-    x, _ = extended_gcd(x, p)
-    return x
+def batch_inverse(values: list[int], p: int = P) -> list[int]:
+    """
+    Montgomery's trick, inverses of all values with a single modular inversion
+    """
+    prefix = [1] * (len(values) + 1)
+    for i, value in enumerate(values):
+        prefix[i + 1] = prefix[i] * value % p
+    inverse = modular_multiplicative_inverse(prefix[-1], p)
+    result = [0] * len(values)
+    for i in range(len(values) - 1, -1, -1):
+        result[i] = inverse * prefix[i] % p
+        inverse = inverse * values[i] % p
+    return result
+
+
+@functools.lru_cache(maxsize=1024)
+def lagrange_weights(x: tuple[int, ...]) -> tuple[int, ...]:
+    """
+    拉格朗日基函数在 0 处的值，只与 x 有关，x 相同的 shares 可以复用
+    a0 = sum(y[i] * weights[i])
+    """
+    length = len(x)
+    if len(set(v % P for v in x)) != length:
+        raise ValueError('x of shares should be distinct')
+    # numerator i is the product of all x except x[i]
+    prefix = [1] * (length + 1)
+    suffix = [1] * (length + 1)
+    for i in range(length):
+        prefix[i + 1] = prefix[i] * x[i] % P
+        suffix[length - i - 1] = suffix[length - i] * x[length - i - 1] % P
+    numerators = [prefix[i] * suffix[i + 1] % P for i in range(length)]
+    denominators = []
+    for i in range(length):
+        d = 1
+        for j in range(length):
+            if i != j:
+                d = d * (x[j] - x[i]) % P
+        denominators.append(d)
+    return tuple(n * d % P for n, d in zip(numerators, batch_inverse(denominators)))
 
 
 def lagrange(shares: Shares) -> int:
     """
     计算拉格朗日插值的常数项 a0
     """
-    x = [i.x for i in shares]
-    length = len(shares)
-    s = 0
-    for i in range(length):
-        pi = 1
-        for j in range(length):
-            if i == j:
-                continue
-            pi *= x[j] * modular_multiplicative_inverse(x[j] - x[i]) % P
-        s = (s + shares[i].y * pi) % P
-    return s
-
-
-def generate(secret: int, num: int, threshold: int) -> Shares:
-    def evaluate(coefficient: list[int], x: int) -> int:
-        acc = 0
-        power = 1
-        for c in coefficient:
-            acc = (acc + c * power) % P
-            power *= x % P
-        return acc
-
-    coefficient = [secret] + [secrets.randbelow(P) for i in range(threshold - 1)]
-    shares = []
-    for i in range(num):
-        x = secrets.randbelow(P)
-        shares.append(Share(x=x, y=evaluate(coefficient, x)))
-    return shares
-
-
-def encrypt(secret: str, num: int = 7, threshold: int = 0) -> Shares:
+    weights = lagrange_weights(tuple(share.x for share in shares))
+    return sum(share.y * weight for share, weight in zip(shares, weights)) % P
+
+
+def holder_x(fingerprint: str) -> int:
+    """
+    由托管人公钥指纹确定的非零 32 位 x，同一托管人的 shares x 相同，可复用插值权重
+    """
+    x = int.from_bytes(hashlib.sha256(fingerprint.encode()).digest()[:X_SIZE], 'big')
+    return x or 1
+
+
+def evaluate(coefficient: Sequence[int], x: int) -> int:
+    """
+    Horner's method, coefficient[0] is the constant term
+    """
+    acc = 0
+    for c in reversed(coefficient):
+        acc = (acc * x + c) % P
+    return acc
+
+
+def generate(secret: int, num: int, threshold: int, x: Optional[Sequence[int]] = None) -> Shares:
+    """
+    Args:
+        x: x of each share, random if not given
+    """
+    if x is None:
+        x = [secrets.randbelow(P - 1) + 1 for _ in range(num)]
+    elif len(set(x)) != len(x) or not all(0 < i < P for i in x):
+        # e.g. colliding holder_x, the secret could not be recovered
+        raise ValueError('x of shares should be distinct and in (0, P)')
+    coefficient = [secret] + [secrets.randbelow(P) for _ in range(threshold - 1)]
+    return [Share(x=i, y=evaluate(coefficient, i)) for i in x]
+
+
+def _to_int(secret: str) -> int:
     if len(secret) > MAX_LENGTH:
         raise ValueError(f'length of secret should less than {MAX_LENGTH}')
     secret = int.from_bytes(secret.encode(), byteorder='little')
     if secret >= P:
         raise ValueError(f'secret should not bigger than P = {P}')
+    return secret
+
+
+def _threshold(num: int, threshold: int) -> int:
     if threshold == 0:
-        threshold = num // 2 + 1
-    elif threshold > num:
+        return num // 2 + 1
+    if threshold > num:
         raise ValueError('threshold is bigger than num, secret could not be recovered')
-    return generate(secret, num, threshold)
+    return threshold
+
+
+def encrypt(secret: str, num: int = 7, threshold: int = 0, x: Optional[Sequence[int]] = None) -> Shares:
+    if x is not None:
+        num = len(x)
+    return generate(_to_int(secret), num, _threshold(num, threshold), x)
+
+
+def encrypt_many(secrets_list: Sequence[str], x: Sequence[int], threshold: int = 0) -> list[Shares]:
+    """
+    批量加密，所有 secret 使用相同的 x，如各托管人的 holder_x
+    """
+    threshold = _threshold(len(x), threshold)
+    return [generate(_to_int(secret), len(x), threshold, x) for secret in secrets_list]
+
+
+def load_shares(data: bytes) -> Shares:
+    """
+    读取解密后的 shares，二进制格式的记录可直接拼接，旧格式为每份两行十进制数
+    """
+    if data[:1] == bytes([VERSION]):
+        if len(data) % RECORD_SIZE:
+            raise ValueError('truncated share record')
+        return [Share.unpack(data[i:i + RECORD_SIZE]) for i in range(0, len(data), RECORD_SIZE)]
+    lines = data.decode().split()
+    return [Share(x=int(lines[i * 2]), y=int(lines[i * 2 + 1])) for i in range(len(lines) // 2)]
 
 
 def decrypt(share: Shares) -> str:
     return lagrange(share).to_bytes(length=MAX_LENGTH, byteorder='little').decode().replace('\x00', '')
 
 
+def decrypt_many(shares_list: list[Shares]) -> list[str]:
+    """
+    批量解密，x 相同的各组 shares 共用插值权重
+    """
+    return [decrypt(shares) for shares in shares_list]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='shamir secret sharing encryption and decryption')
-    parser.add_argument('--decrypt', '-d', type=str,
-                        help='decrypt from a file of key shares')
+    parser.add_argument('--decrypt', '-d', type=str, nargs='+',
+                        help='decrypt from files of decrypted shares, binary or text, one secret per file')
     parser.add_argument('--encrypt', '-e', type=str,
                         help='encrypt a given string')
     args = parser.parse_args()
 
     if args.decrypt:
-        with open(args.decrypt, encoding='utf-8') as f:
-            lines = f.readlines()
-        shares = []
-        for i in range(len(lines) // 2):
-            shares.append(Share(x=int(lines[i * 2]), y=int(lines[i * 2 + 1])))
-        print(decrypt(shares))
+        shares_list = []
+        for path in args.decrypt:
+            with open(path, 'rb') as f:
+                shares_list.append(load_shares(f.read()))
+        for secret in decrypt_many(shares_list):
+            print(secret)
     if args.encrypt:
         print(encrypt(args.encrypt))
@@ -0,0 +1,110 @@
+import asyncio
+import time
+from typing import Optional
+
+from tortoise.transactions import in_transaction
+
+import models
+from config import config
+from shamir import ShamirEmail
+from shamir.gpg import encrypt_shares
+from utils.metrics import get_metric, register_gauge
+
+# (email, user_id, attempt), emails are only kept in memory
+# escrows lost on shutdown are queued again on the next login of the user
+queue: Optional[asyncio.Queue] = None
+queued: set[int] = set()
+workers: list[asyncio.Task] = []
+retries: set[asyncio.TimerHandle] = set()
+stopped = False
+
+register_gauge('escrow.queued', lambda: len(queued))
+
+
+async def escrow(email: str, user_id: int):
+    """
+    加密保存用户邮箱的 shamir shares，已存在时跳过
+    """
+    if await ShamirEmail.filter(user_id=user_id).exists():
+        return
+    shares = await asyncio.to_thread(encrypt_shares, email)
+    async with in_transaction() as connection:
+        # serialize escrows of the same user across processes so that only one share set is saved
+        await models.User.all_objects.filter(id=user_id).select_for_update().using_db(connection).first()
+        if await ShamirEmail.filter(user_id=user_id).using_db(connection).exists():
+            return
+        await ShamirEmail.all().using_db(connection).bulk_create(
+            [ShamirEmail(user_id=user_id, **share) for share in shares]
+        )
+
+
+def enqueue(email: str, user_id: int, attempt: int = 0) -> bool:
+    """
+    Returns:
+        False if the queue is full or stopped
+    """
+    if stopped:
+        return False
+    if attempt == 0 and user_id in queued:
+        return True
+    start()
+    try:
+        queue.put_nowait((email, user_id, attempt))
+    except asyncio.QueueFull:
+        print(f'escrow queue full, email of user {user_id} dropped')
+        queued.discard(user_id)
+        return False
+    queued.add(user_id)
+    return True
+
+
+def retry(email: str, user_id: int, attempt: int):
+    def fire():
+        retries.discard(handle)
+        enqueue(email, user_id, attempt)
+
+    handle = asyncio.get_running_loop().call_later(2 ** (attempt - 1), fire)
+    retries.add(handle)
+
+
+async def work():
+    while True:
+        email, user_id, attempt = await queue.get()
+        start_time = time.monotonic()
+        try:
+            await escrow(email, user_id)
+            queued.discard(user_id)
+            get_metric('escrow').observe(time.monotonic() - start_time)
+        except Exception as e:
+            get_metric('escrow').error()
+            if attempt + 1 < config.escrow_retries:
+                print(f'escrow email of user {user_id} failed, retrying: {e}')
+                retry(email, user_id, attempt + 1)
+            else:
+                print(f'escrow email of user {user_id} failed: {e}')
+                queued.discard(user_id)
+        finally:
+            queue.task_done()
+
+
+def start():
+    global queue, stopped
+    stopped = False
+    if queue is None:
+        queue = asyncio.Queue(config.escrow_queue_size)
+        for _ in range(config.escrow_workers):
+            workers.append(asyncio.create_task(work()))
+
+
+async def stop():
+    global queue, stopped
+    stopped = True
+    for handle in retries:
+        handle.cancel()
+    retries.clear()
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    workers.clear()
+    queue = None
+    queued.clear()
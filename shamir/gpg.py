@@ -1,24 +1,89 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, NamedTuple
+
 import gnupg
 
-from shamir import ShamirEmail
-from shamir.core import encrypt
+try:
+    import pgpy
+except ImportError:  # optional, in-process encryption
+    pgpy = None
+
+from config import config
+from shamir.core import encrypt, Share, holder_x
 
 gpg = gnupg.GPG()
-keys = gpg.list_keys()
+executor: Optional[ThreadPoolExecutor] = None
+
+
+class Recipient(NamedTuple):
+    fingerprint: str
+    uid: str
+    key: Optional['pgpy.PGPKey'] = None  # parsed public key, for the in-process backend
+
+
+def _parse_key(fingerprint: str) -> Optional['pgpy.PGPKey']:
+    if pgpy is None or config.gpg_backend != 'pgpy':
+        return None
+    try:
+        key, _ = pgpy.PGPKey.from_blob(gpg.export_keys(fingerprint))
+        return key
+    except Exception as e:
+        print(f'parse gpg key {fingerprint} failed, encrypting with gpg: {e}')
+        return None
+
+
+recipients: list[Recipient] = []
+refreshed_at = 0.0
+
+
+def refresh_keys() -> list[Recipient]:
+    """
+    重新读取 gpg 公钥，增删托管人的公钥后调用
+    """
+    global recipients, refreshed_at
+    recipients = [
+        Recipient(key['fingerprint'], key['uids'][0], _parse_key(key['fingerprint'])) for key in gpg.list_keys()
+    ]
+    refreshed_at = time.monotonic()
+    return recipients
+
+
+def get_keys() -> list[Recipient]:
+    if not refreshed_at or (config.gpg_keys_ttl and time.monotonic() - refreshed_at > config.gpg_keys_ttl):
+        refresh_keys()
+    return recipients
+
+
+def _encrypt_share(share: Share, recipient: Recipient) -> dict:
+    # binary share record in a binary (non-armored) pgp message
+    if recipient.key is not None:
+        try:
+            message = recipient.key.encrypt(pgpy.PGPMessage.new(share.pack()))
+            return {'data': bytes(message), 'encrypted_by': recipient.uid}
+        except Exception as e:
+            print(f'encrypt with {recipient.uid} in process failed, encrypting with gpg: {e}')
+    encrypted = gpg.encrypt(share.pack(), recipients=recipient.fingerprint, always_trust=True, armor=False)
+    if not encrypted.ok:
+        raise RuntimeError(f'gpg encrypt with {recipient.uid} failed: {encrypted.status}')
+    return {'data': encrypted.data, 'encrypted_by': recipient.uid}
 
 
-async def encrypt_email(email: str, user_id: int):
-    length = len(keys)
-    shares = encrypt(email, length)
-    objs = []
-    for i in range(length):
-        objs.append(ShamirEmail(
-            key=str(gpg.encrypt(str(shares[i]), recipients=keys[i]['fingerprint'], always_trust=True)),
-            encrypted_by=keys[i]['uids'][0],
-            user_id=user_id
-        ))
-    await ShamirEmail.bulk_create(objs)
+def encrypt_shares(email: str) -> list[dict]:
+    """
+    每个 gpg 公钥加密一份，阻塞
+    公钥可以在进程内解析时直接加密，否则各份在线程池中启动 gpg 子进程并行加密
+    """
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=config.gpg_workers, thread_name_prefix='gpg')
+    keys = get_keys()
+    shares = encrypt(email, x=[holder_x(key.fingerprint) for key in keys])
+    if all(key.key is not None for key in keys):
+        return [_encrypt_share(share, key) for share, key in zip(shares, keys)]
+    return list(executor.map(_encrypt_share, shares, keys))
 
 
 if __name__ == '__main__':
-    pass
+    for recipient in refresh_keys():
+        print(recipient.fingerprint, recipient.uid)
@@ -1,33 +1,133 @@
+import argparse
 import asyncio
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
 
 from tortoise import Tortoise
+from tortoise.transactions import in_transaction
 
 import config
-from gpg import encrypt_email
 from models import User, RegisteredEmail
-from utils.auth import rsa_decrypt, make_identifier
+from shamir import ShamirEmail
+from shamir.gpg import encrypt_shares
+from utils.auth import rsa_decrypt, make_identifier, sha3
 
 
-async def run():
-    for user in (await User.all()):
-        email = rsa_decrypt(user.email)
-        user.identifier = make_identifier(email)
-        await asyncio.gather(
-            user.save(),
-            encrypt_email(email, user.id),
-            RegisteredEmail.add(email)
+def prepare(user_id: int, encrypted_email: str) -> tuple[int, str, str, list[dict]]:
+    """
+    在子进程中执行 rsa 解密、identifier 计算与 shamir 加密
+    """
+    email = rsa_decrypt(encrypted_email)
+    return user_id, make_identifier(email), sha3(email), encrypt_shares(email)
+
+
+def read_checkpoint(path: str) -> int:
+    try:
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(path: str, last_id: int):
+    # atomic, a crash leaves either the old or the new checkpoint
+    with open(f'{path}.tmp', 'w') as f:
+        f.write(str(last_id))
+    os.replace(f'{path}.tmp', path)
+
+
+def write_failed(path: str, user_ids: list[int]):
+    with open(path, 'a') as f:
+        f.writelines(f'{user_id}\n' for user_id in user_ids)
+
+
+async def migrate_chunk(users: list[User], executor: Executor) -> list[int]:
+    """
+    Returns:
+        ids of the users failed to migrate, left unchanged
+    """
+    loop = asyncio.get_running_loop()
+    prepared = await asyncio.gather(*[
+        loop.run_in_executor(executor, prepare, user.id, user.email) for user in users
+    ], return_exceptions=True)
+
+    # an undecryptable email should not stop the whole migration
+    results, failed, migrated = [], [], {}
+    for user, result in zip(users, prepared):
+        if isinstance(result, Exception):
+            print(f'migrate email of user {user.id} failed, skipped: {result!r}')
+            failed.append(user.id)
+        else:
+            results.append(result)
+            migrated[user.id] = user
+    if not results:
+        return failed
+
+    users = migrated
+    # chunks are redone after a crash, skip the users already escrowed
+    hashes = [hash for _, _, hash, _ in results]
+    escrowed = set(await ShamirEmail.filter(user_id__in=list(users)).distinct().values_list('user_id', flat=True))
+    registered = set(await RegisteredEmail.filter(hash__in=hashes).values_list('hash', flat=True))
+    shares = []
+    for user_id, identifier, _, encrypted_shares in results:
+        users[user_id].identifier = identifier
+        if user_id not in escrowed:
+            shares += [ShamirEmail(user_id=user_id, **share) for share in encrypted_shares]
+
+    async with in_transaction() as connection:
+        await User.all_objects.all().using_db(connection).bulk_update(list(users.values()), fields=['identifier'])
+        await ShamirEmail.all().using_db(connection).bulk_create(shares)
+        await RegisteredEmail.all().using_db(connection).bulk_create(
+            [RegisteredEmail(hash=hash) for hash in set(hashes) - registered]
         )
-        print(user.id)
+    # let the running servers know through the shared filter
+    await asyncio.gather(*[RegisteredEmail.bloom.add(hash) for hash in hashes])
+    return failed
 
 
-async def main():
-    await Tortoise.init(config=config.TORTOISE_ORM)
+async def run(checkpoint: str, chunk_size: int, workers: int):
+    last_id = read_checkpoint(checkpoint)
+    queryset = User.all_objects.exclude(email='')
+    total = await queryset.filter(id__gt=last_id).count()
+    print(f'{total} users to migrate, starting after user {last_id}')
 
-    await run()
+    done = failed = 0
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            users = await queryset.filter(id__gt=last_id).order_by('id').limit(chunk_size)
+            if not users:
+                break
+            failed_ids = await migrate_chunk(users, executor)
+            if failed_ids:
+                write_failed(f'{checkpoint}.failed', failed_ids)
+            done += len(users)
+            failed += len(failed_ids)
+            last_id = users[-1].id
+            write_checkpoint(checkpoint, last_id)
 
-    await Tortoise.close_connections()
+            elapsed = time.monotonic() - start
+            rate = done / elapsed if elapsed else 0
+            eta = (total - done) / rate if rate else 0
+            print(f'{done}/{total} users, last id {last_id}, {rate:.1f} users/s, eta {eta:.0f}s')
+    print(f'migrated {done - failed} users in {time.monotonic() - start:.0f}s')
+    if failed:
+        print(f'{failed} users failed, their ids are listed in {checkpoint}.failed')
+
+
+async def main(args):
+    await Tortoise.init(config=config.TORTOISE_ORM)
+    try:
+        await run(args.checkpoint, args.chunk_size, args.workers)
+    finally:
+        await Tortoise.close_connections()
 
 
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    parser = argparse.ArgumentParser(description='migrate rsa encrypted emails to identifiers and shamir shares')
+    parser.add_argument('--checkpoint', '-c', default='data/migrate_email.checkpoint',
+                        help='file of the last migrated user id, delete it to start over')
+    parser.add_argument('--chunk-size', '-s', type=int, default=200, help='users per chunk')
+    parser.add_argument('--workers', '-w', type=int, default=os.cpu_count(), help='worker processes')
+    asyncio.run(main(parser.parse_args()))
@@ -1,5 +1,31 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+
+import gnupg
+import jwt
+import orjson
+from aiohttp import ClientError
+from tortoise import Tortoise
+
+from config import MODELS, config
 from main import app
+from admin import expiry, permission, user as user_api
+from admin.serializers import PermissionAdd, PermissionDelete, UserExport
+from models import Permission, User, UserSnapshot, UserRole, KongOutbox, RegisteredEmail
+from shamir import core, escrow, migrate_email, ShamirEmail, gpg as shamir_gpg
+from utils import password, hashers, jwt_utils, kong, outbox, last_login
+from utils.bloom import BloomFilter, SharedBloomFilter, cache as bloom_cache
 from utils.auth import rsa_encrypt, rsa_decrypt, make_password, check_password, make_identifier
+from utils.cache import LRUCache, TieredCache
+from utils.exceptions import BadRequest, ServiceUnavailable
+from utils.keyring import KeyRing
+from utils.lease import Lease
+from utils.kong_client import CircuitBreaker, KongClient
+from utils.orm import encode_cursor, decode_cursor, export_ndjson
+from utils.revocation import revoke_tokens, is_revoked
+from utils.values import now
 
 print(app)
 
@@ -19,6 +45,723 @@ def test_password():
     assert check_password(password, encrypted) is True
 
 
+def test_password_hashers():
+    encrypted = hashers.make_password('password', 'scrypt', {'n': 2 ** 10})
+    assert len(encrypted) <= 128
+    assert hashers.check_password('password', encrypted) is True
+    assert hashers.check_password('wrong password', encrypted) is False
+    assert hashers.must_update(encrypted, 'scrypt', {'n': 2 ** 10}) is False
+    assert hashers.must_update(encrypted, 'scrypt') is True
+    assert hashers.must_update(encrypted, 'pbkdf2_sha256') is True
+
+
+def test_password_async():
+    async def run():
+        encrypted = await password.make_password('password')
+        assert await password.check_password('password', encrypted) is True
+        assert await password.check_password('wrong password', encrypted) is False
+
+    asyncio.run(run())
+    password.shutdown()
+
+
 def test_hash():
     identifier = make_identifier('email')
     assert len(identifier) <= 128
+    assert make_identifier('email') == identifier
+    assert make_identifier('email', iterations=2) != identifier
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.set(1, 'a')
+    cache.set(2, 'b')
+    assert cache.get(1) == 'a'
+    cache.set(3, 'c')
+    assert 2 not in cache
+    assert cache.get(1) == 'a'
+    cache.delete(1)
+    assert cache.get(1) is None
+    assert len(cache) == 1
+
+
+def test_tiered_cache():
+    async def run():
+        # the caches of two processes
+        first = TieredCache('test-tiered')
+        second = TieredCache('test-tiered')
+        await first.set(1, {'key': 'a'})
+        assert await second.get(1) == {'key': 'a'}
+        await second.delete(1)
+        assert await first.get(1) is None
+
+    asyncio.run(run())
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=0.05)
+    breaker.failure()
+    assert breaker.allow() is True
+    breaker.failure()
+    assert breaker.is_open and breaker.allow() is False
+    time.sleep(0.06)
+    # half open, only one probe passes
+    assert breaker.allow() is True
+    assert breaker.allow() is False
+    breaker.success()
+    assert not breaker.is_open and breaker.allow() is True
+    # a failed probe opens it again
+    breaker.failure()
+    breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow() is True
+    breaker.failure()
+    assert breaker.allow() is False
+
+
+class StubResponse:
+    def __init__(self, status: int, data: dict):
+        self.status = status
+        self.data = data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def json(self, content_type=None):
+        return self.data
+
+
+class StubSession:
+    """
+    responds with the given statuses in order, 0 for a connection error
+    """
+    closed = False
+
+    def __init__(self, *statuses: int, delay: float = 0):
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.calls = []
+
+    def request(self, method, path, json=None, timeout=None):
+        self.calls.append((method, path))
+        status = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+        session = self
+
+        class Context:
+            async def __aenter__(self):
+                await asyncio.sleep(session.delay)
+                if status == 0:
+                    raise ClientError()
+                return StubResponse(status, {'status': status})
+
+            async def __aexit__(self, *args):
+                pass
+
+        return Context()
+
+
+def test_kong_client(monkeypatch):
+    monkeypatch.setattr(config, 'kong_retries', 2)
+    monkeypatch.setattr(config, 'kong_retry_backoff', 0)
+
+    async def request(session: StubSession, *args, **kwargs):
+        client = KongClient()
+        client.session = session
+        return await client.request(*args, **kwargs)
+
+    async def run():
+        # idempotent calls are retried
+        session = StubSession(502, 200)
+        assert await request(session, 'GET', '/consumers/{id}', id=1) == (200, {'status': 200})
+        assert session.calls == [('GET', '/consumers/1')] * 2
+        # others are not
+        session = StubSession(502)
+        assert await request(session, 'POST', '/consumers/{id}/jwt', json={}, id=1) == (502, {'status': 502})
+        assert len(session.calls) == 1
+        # unless marked idempotent
+        session = StubSession(502)
+        await request(session, 'POST', '/consumers/{id}/acls', json={}, idempotent=True, id=1)
+        assert len(session.calls) == 3
+        # client errors are returned at once
+        session = StubSession(404)
+        assert (await request(session, 'GET', '/consumers/{id}', id=1))[0] == 404
+        assert len(session.calls) == 1
+        # no retry after the deadline
+        session = StubSession(502, delay=0.02)
+        await request(session, 'GET', '/consumers/{id}', timeout=0.01, id=1)
+        assert len(session.calls) == 1
+        # unreachable
+        session = StubSession(0)
+        try:
+            await request(session, 'GET', '/')
+            assert False
+        except ServiceUnavailable:
+            pass
+        assert len(session.calls) == 3
+
+        # fail fast once the breaker is open
+        client = KongClient()
+        client.session = StubSession(0)
+        for _ in range(config.kong_breaker_threshold):
+            try:
+                await client.request('DELETE', '/consumers/{id}', idempotent=False, id=1)
+            except ServiceUnavailable:
+                pass
+        assert client.breaker.is_open
+        try:
+            await client.request('GET', '/')
+            assert False
+        except ServiceUnavailable:
+            pass
+        assert len(client.session.calls) == config.kong_breaker_threshold
+
+    asyncio.run(run())
+
+
+def test_keyring(tmp_path):
+    for algorithm in ('RS256', 'EdDSA'):
+        path = str(tmp_path / algorithm)
+        keyring = KeyRing(path, algorithm, count=2)
+        try:
+            keyring.sign({'uid': 1})
+            assert False
+        except RuntimeError:
+            pass
+        # must be provisioned outside debug mode
+        try:
+            keyring.ensure()
+            assert False
+        except RuntimeError:
+            pass
+        other = KeyRing(path, algorithm, count=2)
+        keyring.ensure(create=True)
+        other.ensure()
+        assert list(keyring.keys) == list(other.keys) and len(other.keys) == 1
+        token = keyring.sign({'uid': 1})
+        assert other.verify(token) == {'uid': 1}
+        # rotated by the cli, running processes sign with the new keys
+        rotator = KeyRing(path, algorithm, count=2)
+        rotator.rotate()
+        kid = rotator.rotate()
+        assert jwt.get_unverified_header(other.sign({'uid': 2}))['kid'] == kid
+        assert len(other.jwks()['keys']) == 2
+        assert keyring.verify(token) is None
+        assert KeyRing(path, algorithm).verify(keyring.sign({'uid': 2})) == {'uid': 2}
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000)
+    for i in range(1000):
+        bloom.add(str(i))
+    assert all(str(i) in bloom for i in range(1000))
+    assert sum(str(i) in bloom for i in range(1000, 11000)) < 300
+
+    async def run():
+        first = SharedBloomFilter('test-bloom', 1000, sync_interval=0)
+        second = SharedBloomFilter('test-bloom', 1000, sync_interval=0)
+        await first.add('a')
+        assert await second.might_contain('a') is True
+        assert await second.might_contain('b') is False
+
+        # the shared cache is flushed, then an item is added
+        lost = []
+
+        async def on_lost():
+            lost.append(1)
+
+        second.on_lost = on_lost
+        await first.add('b')
+        assert await second.might_contain('b') is True
+        await bloom_cache.clear()
+        await first.add('c')
+        assert await second.might_contain('c') is True
+        assert lost == [1]
+
+    asyncio.run(run())
+
+
+def test_revocation():
+    async def run():
+        payload = {'uid': 12345, 'iat': int(time.time()) - 10}
+        assert await is_revoked(payload) is False
+        await revoke_tokens(12345)
+        assert await is_revoked(payload) is True
+        assert await is_revoked({'uid': 12345, 'iat': int(time.time())}) is False
+
+    asyncio.run(run())
+
+
+def test_get_jwt_credential(monkeypatch):
+    credential = {'id': 'new', 'key': 'key', 'secret': 'secret', 'algorithm': 'HS256'}
+
+    async def list_jwt_credentials(id: int):
+        return [credential]
+
+    monkeypatch.setattr(kong, 'list_jwt_credentials', list_jwt_credentials)
+
+    async def run():
+        # a deleted credential cached again by a concurrent lookup
+        await kong.credential_cache.set(34567, dict(credential, id='deleted', secret='deleted'))
+        assert (await kong.get_jwt_credential(34567, cached=True)).id == 'deleted'
+        assert (await kong.get_jwt_credential(34567)).id == 'new'
+        assert (await kong.find_jwt_credential(34567)).id == 'new'
+
+    asyncio.run(run())
+
+
+def test_verify_revoked_token(monkeypatch):
+    lookups = []
+
+    async def find_jwt_credential(user_id):
+        lookups.append(user_id)
+        return None
+
+    monkeypatch.setattr(config, 'jwt_mode', 'kong')
+    monkeypatch.setattr(jwt_utils, 'find_jwt_credential', find_jwt_credential)
+
+    async def run():
+        secret = 'a secret that is long enough for hs256'
+        token = jwt.encode({'uid': 23456, 'type': 'refresh', 'iat': int(time.time()) - 10}, secret)
+        # unknown users are looked up once
+        for _ in range(3):
+            assert await jwt_utils.verify_token(token, 'refresh') is None
+        assert lookups == [23456]
+        # revoked tokens are rejected before the lookup
+        await revoke_tokens(23457)
+        token = jwt.encode({'uid': 23457, 'type': 'refresh', 'iat': int(time.time()) - 10}, secret)
+        for _ in range(3):
+            assert await jwt_utils.verify_token(token, 'refresh') is None
+        assert lookups == [23456]
+
+    asyncio.run(run())
+
+
+def test_cursor():
+    permission = Permission(id=3, end_time=datetime(2022, 1, 1, tzinfo=timezone.utc))
+    cursor = encode_cursor([permission.end_time, permission.id])
+    assert decode_cursor(cursor, Permission, ('end_time', 'id')) == [permission.end_time, 3]
+    for invalid in ('garbage', encode_cursor([3])):
+        try:
+            decode_cursor(invalid, Permission, ('end_time', 'id'))
+            assert False
+        except BadRequest:
+            pass
+
+
+def test_user_snapshot():
+    async def main():
+        await Tortoise.init(db_url='sqlite://:memory:', modules={'models': MODELS})
+        user = User(id=1, nickname='user', roles=['admin'], joined_time=datetime(2022, 1, 1, tzinfo=timezone.utc),
+                    last_login=datetime(2022, 1, 2, tzinfo=timezone.utc))
+        snapshot = UserSnapshot.from_user(user)
+        for cached in (snapshot.to_user(), UserSnapshot(*snapshot.to_list()).to_user()):
+            assert cached.id == 1 and cached.roles == ['admin'] and cached.last_login == user.last_login
+            assert not hasattr(cached, 'password')
+        # instances do not share mutable fields
+        snapshot.to_user().roles.append('ban_hole')
+        assert snapshot.to_user().roles == ['admin']
+        await Tortoise.close_connections()
+
+    asyncio.run(main())
+
+
+async def init_db():
+    await Tortoise.init(db_url='sqlite://:memory:', modules={'models': MODELS})
+    await Tortoise.generate_schemas()
+
+
+def test_roles_before_dispatch(monkeypatch, tmp_path):
+    keyring = KeyRing(str(tmp_path))
+    keyring.ensure(create=True)
+    monkeypatch.setattr(config, 'jwt_mode', 'local')
+    monkeypatch.setattr(jwt_utils, 'keyring', keyring)
+    monkeypatch.setattr(outbox, 'notify', lambda: None)
+    monkeypatch.setattr(expiry, 'schedule', lambda *args: None)
+
+    async def refresh(user_id: int) -> list[str]:
+        access, _ = await jwt_utils.create_tokens(await User.get(id=user_id))
+        return keyring.verify(access)['roles']
+
+    async def main():
+        await init_db()
+        admin = await User.create(email='', identifier='admin', password='')
+        user = await User.create(email='', identifier='user', password='')
+
+        await permission.add_permission(user.id, PermissionAdd(name='ban_hole', reason='test'), admin)
+        # refreshed before the outbox is dispatched
+        assert await refresh(user.id) == ['ban_hole']
+        assert (await User.get(id=user.id)).roles == ['ban_hole']
+        assert await UserRole.filter(user_id=user.id).values_list('role', flat=True) == ['ban_hole']
+        assert await KongOutbox.filter(consumer_id=user.id).values_list('action', flat=True) == ['add']
+
+        await permission.delete_permission(user.id, 'ban_hole', PermissionDelete(reason='test'), admin)
+        assert await refresh(user.id) == []
+        assert (await User.get(id=user.id)).roles == []
+        assert await UserRole.filter(user_id=user.id).count() == 0
+        await Tortoise.close_connections()
+
+    asyncio.run(main())
+
+
+def test_sync_permissions(monkeypatch):
+    sent = []
+
+    async def add_acl(id: int, group: str):
+        sent.append(('add', id, group))
+
+    async def delete_acl(id: int, group: str):
+        sent.append(('delete', id, group))
+
+    monkeypatch.setattr(outbox, 'notify', lambda: None)
+    monkeypatch.setattr(expiry, 'schedule', lambda *args: None)
+    monkeypatch.setattr(kong, 'add_acl', add_acl)
+    monkeypatch.setattr(kong, 'delete_acl', delete_acl)
+
+    async def main():
+        await init_db()
+        admin = await User.create(email='', identifier='admin', password='')
+        users = [await User.create(email='', identifier=str(i), password='', roles=['admin']) for i in range(2)]
+        # expires at once, its acl not added yet and backing off after failures
+        await permission.add_permission(users[0].id, PermissionAdd(name='ban_hole', days=0), admin)
+        await KongOutbox.filter(consumer_id=users[0].id).update(attempts=3, next_try=now() + timedelta(minutes=1))
+        await Permission.create(user=users[1], made_by=admin, name='ban_hole', end_time=now() + timedelta(days=1))
+
+        assert await permission.sync_permissions() == 1
+        assert (await User.get(id=users[0].id)).roles == ['admin']
+        assert await UserRole.filter(user_id=users[0].id).values_list('role', flat=True) == ['admin']
+        # the pending add is replaced by the delete
+        assert await KongOutbox.filter(consumer_id=users[0].id).values_list('action', flat=True) == ['delete']
+        await outbox.dispatch()
+        assert sent == [('delete', users[0].id, 'ban_hole')]
+        # not expired yet
+        assert await Permission.filter(user_id=users[1].id, synced=False).exists()
+        assert not await KongOutbox.filter(consumer_id=users[1].id).exists()
+        await Tortoise.close_connections()
+
+    asyncio.run(main())
+
+
+def test_export(monkeypatch):
+    async def read(response) -> list[dict]:
+        return [orjson.loads(line) async for chunk in response.body_iterator for line in chunk.splitlines()]
+
+    async def main():
+        await init_db()
+        users = [
+            await User.create(email='', identifier=str(i), password='', roles=roles)
+            for i, roles in enumerate((['ban_hole'], ['ban_chat', 'admin'], ['admin'], [], ['ban_hole']))
+        ]
+        await UserRole.sync(users)
+
+        # chunks exactly full, and a last one partly
+        for chunk_size in (1, 5, 2):
+            chunks = [chunk async for chunk in export_ndjson(User.all(), ('id', 'roles'), chunk_size)]
+            assert len(chunks) == -(-5 // chunk_size)
+            rows = [orjson.loads(line) for chunk in chunks for line in chunk.splitlines()]
+            assert rows == [{'id': user.id, 'roles': user.roles} for user in users]
+
+        monkeypatch.setattr(config, 'export_chunk_size', 2)
+        rows = await read(await user_api.export_users(UserExport(role='ban_*')))
+        assert [row['id'] for row in rows] == [users[0].id, users[1].id, users[4].id]
+        # json fields as json
+        assert rows[1]['roles'] == ['ban_chat', 'admin'] and isinstance(rows[1]['config'], dict)
+        rows = await read(await user_api.export_users(UserExport(role='admin')))
+        assert [row['id'] for row in rows] == [users[1].id, users[2].id]
+
+        await Permission.create(user=users[0], made_by=users[2], name='ban_hole', reason='test')
+        rows = await read(await permission.export_permissions())
+        assert len(rows) == 1 and rows[0]['user_id'] == users[0].id and rows[0]['made_by_id'] == users[2].id
+        await Tortoise.close_connections()
+
+    asyncio.run(main())
+
+
+def test_last_login(monkeypatch):
+    async def main():
+        await init_db()
+        try:
+            await User.create(id=1, email='', identifier='a', password='')
+            await User.create(id=2, email='', identifier='b', password='')
+            first, second = datetime(2022, 1, 1, tzinfo=timezone.utc), datetime(2022, 1, 2, tzinfo=timezone.utc)
+            last_login.record(1, first)
+            last_login.record(1, second)
+            last_login.record(2, first)
+            assert await last_login.flush() == 2
+            assert last_login.pending == {}
+            assert (await User.get(id=1)).last_login == second
+            assert (await User.get(id=2)).last_login == first
+
+            # failed writes are put back, without overwriting the logins recorded in the meantime
+            async def bulk_update(*args, **kwargs):
+                last_login.record(1, third)
+                raise ConnectionError
+
+            third = datetime(2022, 1, 3, tzinfo=timezone.utc)
+            last_login.record(1, first)
+            last_login.record(2, second)
+            monkeypatch.setattr(User, 'bulk_update', bulk_update)
+            try:
+                await last_login.flush()
+                assert False
+            except ConnectionError:
+                pass
+            assert last_login.pending == {1: third, 2: second}
+            monkeypatch.undo()
+            assert await last_login.flush() == 2
+            assert (await User.get(id=1)).last_login == third
+            assert (await User.get(id=2)).last_login == second
+        finally:
+            last_login.pending.clear()
+            await Tortoise.close_connections()
+
+    asyncio.run(main())
+
+
+def test_lease():
+    async def main():
+        elected = []
+
+        async def on_elected():
+            elected.append(1)
+
+        first, second = Lease('test'), Lease('test')
+        first.on_elected.append(on_elected)
+        assert await first.acquire() is True
+        assert await second.acquire() is False
+        assert await first.acquire() is True and elected == [1]
+        assert await second.extend() is False
+        await second.release()
+        assert await second.acquire() is False
+        await first.release()
+        assert not first.is_leader
+        assert await second.acquire() is True
+
+    asyncio.run(main())
+
+
+def test_expiry_load():
+    async def main():
+        await init_db()
+        user = await User.create(email='', identifier='user', password='')
+        ban = await Permission.create(user=user, made_by=user, name='ban_hole', end_time=now())
+        expiry.schedule(ban.id, ban.end_time)
+        # loaded again on every election
+        await expiry.load()
+        await expiry.load()
+        assert [id for _, id in expiry.heap] == [ban.id]
+        expiry.heap.clear()
+        await Tortoise.close_connections()
+
+    asyncio.run(main())
+
+
+def test_outbox(monkeypatch):
+    sent = []
+
+    async def add_acl(id: int, group: str):
+        sent.append(('add', id, group))
+
+    async def delete_acl(id: int, group: str):
+        if group == 'fail':
+            raise ServiceUnavailable('API gateway unavailable')
+        sent.append(('delete', id, group))
+
+    monkeypatch.setattr(kong, 'add_acl', add_acl)
+    monkeypatch.setattr(kong, 'delete_acl', delete_acl)
+
+    async def main():
+        await init_db()
+        # an unsent change is replaced by a newer one
+        await outbox.enqueue(1, 'ban_hole', 'add')
+        await outbox.enqueue(1, 'ban_hole', 'delete')
+        assert await KongOutbox.all().values_list('action', flat=True) == ['delete']
+        # the latest row of a permission wins, the superseded ones are deleted without sending
+        await KongOutbox.create(consumer_id=2, name='admin', action='add')
+        await KongOutbox.create(consumer_id=2, name='admin', action='delete')
+        assert await outbox.dispatch() == 3
+        assert sorted(sent) == [('delete', 1, 'ban_hole'), ('delete', 2, 'admin')]
+        assert await KongOutbox.all().count() == 0
+
+        # failures are retried with backoff
+        await outbox.enqueue(3, 'fail', 'delete')
+        assert await outbox.dispatch() == 1
+        row = await KongOutbox.get(consumer_id=3)
+        assert row.attempts == 1 and row.next_try > now()
+        assert await outbox.dispatch() == 0
+        row.next_try = now()
+        await row.save()
+        await outbox.dispatch()
+        assert (await KongOutbox.get(consumer_id=3)).attempts == 2
+        await Tortoise.close_connections()
+
+    asyncio.run(main())
+
+
+def test_escrow(monkeypatch):
+    calls = []
+
+    def encrypt_shares(email: str) -> list[dict]:
+        calls.append(email)
+        if email == 'flaky@example.com' and len(calls) == 1:
+            raise RuntimeError('gpg encrypt failed')
+        return [{'data': email.encode(), 'encrypted_by': f'holder{i}'} for i in range(3)]
+
+    monkeypatch.setattr(escrow, 'encrypt_shares', encrypt_shares)
+    monkeypatch.setattr(escrow, 'stopped', False)  # restored for the other tests
+
+    async def main():
+        await init_db()
+        user = await User.create(email='', identifier='user', password='')
+        # concurrent escrows of the same user save only one share set
+        await asyncio.gather(*[escrow.escrow('user@example.com', user.id) for _ in range(3)])
+        assert len(calls) == 3
+        await escrow.escrow('user@example.com', user.id)
+        assert len(calls) == 3
+        assert await ShamirEmail.filter(user_id=user.id).count() == 3
+
+        # retried after a failure
+        calls.clear()
+        other = await User.create(email='', identifier='other', password='')
+        assert escrow.enqueue('flaky@example.com', other.id) is True
+        for _ in range(30):
+            if other.id not in escrow.queued:
+                break
+            await asyncio.sleep(0.1)
+        assert calls == ['flaky@example.com'] * 2
+        assert await ShamirEmail.filter(user_id=other.id).count() == 3
+
+        # pending retries are cancelled on stop, and nothing is queued afterwards
+        calls.clear()
+        failing = await User.create(email='', identifier='failing', password='')
+        assert escrow.enqueue('flaky@example.com', failing.id) is True
+        for _ in range(30):
+            if escrow.retries:
+                break
+            await asyncio.sleep(0.1)
+        handle, = escrow.retries
+        tasks = list(escrow.workers)
+        await escrow.stop()
+        assert handle.cancelled() and not escrow.retries
+        assert all(task.done() for task in tasks)
+        assert escrow.enqueue('user@example.com', failing.id) is False
+        assert escrow.queue is None and calls == ['flaky@example.com']
+        await Tortoise.close_connections()
+
+    asyncio.run(main())
+
+
+def test_migrate_email(monkeypatch, tmp_path):
+    decrypted = []
+
+    def rsa_decrypt(encrypted: str) -> str:
+        if encrypted == 'broken':
+            raise ValueError('decryption failed')
+        decrypted.append(encrypted)
+        return f'{encrypted}@example.com'
+
+    def encrypt_shares(email: str) -> list[dict]:
+        return [{'data': email.encode(), 'encrypted_by': f'holder{i}'} for i in range(3)]
+
+    # the stubs are not seen by worker processes
+    monkeypatch.setattr(migrate_email, 'ProcessPoolExecutor', ThreadPoolExecutor)
+    monkeypatch.setattr(migrate_email, 'rsa_decrypt', rsa_decrypt)
+    monkeypatch.setattr(migrate_email, 'encrypt_shares', encrypt_shares)
+    checkpoint = str(tmp_path / 'checkpoint')
+
+    async def main():
+        await init_db()
+        try:
+            for i, email in enumerate(['a', 'b', 'broken', 'c', 'e'], 1):
+                await User.create(id=i, email=email, identifier=str(i), password='')
+            # the first chunk was migrated before a crash
+            with ThreadPoolExecutor() as executor:
+                users = await User.filter(id__in=[1, 2]).order_by('id')
+                assert await migrate_email.migrate_chunk(users, executor) == []
+            decrypted.clear()
+
+            await migrate_email.run(checkpoint, chunk_size=2, workers=2)
+            assert migrate_email.read_checkpoint(checkpoint) == 5
+            with open(f'{checkpoint}.failed') as f:
+                assert f.read() == '3\n'
+            assert decrypted == ['a', 'b', 'c', 'e']
+            # the broken email does not stop the others
+            assert (await User.get(id=3)).identifier == '3'
+            assert (await User.get(id=4)).identifier == make_identifier('c@example.com')
+            assert await ShamirEmail.filter(user_id=3).count() == 0
+            for user_id in (1, 2, 4, 5):
+                assert await ShamirEmail.filter(user_id=user_id).count() == 3
+            assert await RegisteredEmail.all().count() == 4
+
+            # resumed after the checkpoint
+            decrypted.clear()
+            await User.create(id=6, email='d', identifier='6', password='')
+            await migrate_email.run(checkpoint, chunk_size=2, workers=2)
+            assert decrypted == ['d']
+            assert migrate_email.read_checkpoint(checkpoint) == 6
+            assert await ShamirEmail.all().count() == 15
+            assert await RegisteredEmail.all().count() == 5
+        finally:
+            await Tortoise.close_connections()
+
+    asyncio.run(main())
+
+
+def test_pgpy_shares(monkeypatch, tmp_path):
+    assert shamir_gpg.pgpy is not None
+    gpg = gnupg.GPG(gnupghome=str(tmp_path))
+    for i in range(3):
+        gpg.gen_key(gpg.gen_key_input(
+            key_type='RSA', key_length=2048, name_email=f'holder{i}@example.com', no_protection=True
+        ))
+    monkeypatch.setattr(shamir_gpg, 'gpg', gpg)
+    monkeypatch.setattr(config, 'gpg_backend', 'pgpy')
+    monkeypatch.setattr(shamir_gpg, 'recipients', [])
+    monkeypatch.setattr(shamir_gpg, 'refreshed_at', 0.0)
+
+    assert all(recipient.key is not None for recipient in shamir_gpg.refresh_keys())
+    # no fallback to gpg subprocesses
+    monkeypatch.setattr(gpg, 'encrypt', None)
+    shares = shamir_gpg.encrypt_shares('user@example.com')
+    # encrypted in process, decrypted by gpg
+    records = b''
+    for share in shares:
+        decrypted = gpg.decrypt(share['data'])
+        assert decrypted.ok
+        records += decrypted.data
+    assert core.decrypt(core.load_shares(records)) == 'user@example.com'
+
+
+def test_shamir():
+    values = [3, 5, 7, core.P - 1]
+    assert [v * inverse % core.P for v, inverse in zip(values, core.batch_inverse(values))] == [1] * 4
+    shares_list = [core.encrypt(f'user{i}@example.com', 7) for i in range(10)]
+    assert core.decrypt_many(shares_list) == [f'user{i}@example.com' for i in range(10)]
+    # any threshold shares are enough
+    assert core.decrypt(shares_list[0][3:]) == 'user0@example.com'
+
+    # shares of the same holders reuse the weights
+    x = [core.holder_x(f'fingerprint{i}') for i in range(7)]
+    shares_list = core.encrypt_many([f'user{i}@example.com' for i in range(10)], x)
+    assert core.decrypt_many(shares_list) == [f'user{i}@example.com' for i in range(10)]
+    for invalid in ([1, 2, 2], [0, 1, 2]):
+        try:
+            core.encrypt('user@example.com', x=invalid)
+            assert False
+        except ValueError:
+            pass
+    share = core.Share.from_bytes(shares_list[0][0].to_bytes())
+    assert (share.x, share.y) == (shares_list[0][0].x, shares_list[0][0].y)
+    records = b''.join(share.pack() for share in shares_list[0])
+    assert core.decrypt(core.load_shares(records)) == 'user0@example.com'
+    text = '\n'.join(str(share) for share in shares_list[0]).encode()
+    assert core.decrypt(core.load_shares(text)) == 'user0@example.com'
+    corrupted = bytearray(records)
+    corrupted[10] ^= 1
+    try:
+        core.load_shares(bytes(corrupted))
+        assert False
+    except ValueError:
+        pass
@@ -1,6 +1,7 @@
 import base64
 import hashlib
 import secrets
+from typing import List, Optional
 
 import pyotp
 from aiocache import caches
@@ -8,6 +9,8 @@ from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import padding
 
 from config import config
+from utils import hashers
+from utils.cache import LRUCache
 
 cache = caches.get('default')
 
@@ -16,33 +19,43 @@ def sha3(string: str) -> str:
     return hashlib.sha3_512(string.encode()).hexdigest()
 
 
-def make_identifier(raw_email: str) -> str:
-    iterations = 1
-    byte_email = bytes(raw_email.encode('utf-8'))
-    salt = base64.b64decode(config.identifier_salt)
-    return hashlib.pbkdf2_hmac('sha3_512', byte_email, salt, iterations).hex()
+IDENTIFIER_SALT = base64.b64decode(config.identifier_salt)
 
+# (iterations, sha3 digest of email) -> identifier, raw emails are not kept in memory
+identifier_cache = LRUCache(config.identifier_cache_size)
 
-def password_hash(algorithm: str, raw_password: str, salt: str, iterations: int) -> str:
-    return base64.b64encode(
-        hashlib.pbkdf2_hmac(algorithm, raw_password.encode(), salt.encode(), iterations)
-    ).decode()
+
+def make_identifier(raw_email: str, iterations: Optional[int] = None) -> str:
+    iterations = iterations or config.identifier_iterations
+    byte_email = raw_email.encode('utf-8')
+    key = (iterations, hashlib.sha3_256(byte_email).digest())
+    identifier = identifier_cache.get(key)
+    if identifier is None:
+        identifier = hashlib.pbkdf2_hmac('sha3_512', byte_email, IDENTIFIER_SALT, iterations).hex()
+        identifier_cache.set(key, identifier)
+    return identifier
+
+
+def identifier_candidates(raw_email: str) -> List[str]:
+    """
+    当前的 identifier 在前，其后为旧迭代次数生成的 identifier
+    """
+    return [make_identifier(raw_email)] + [
+        make_identifier(raw_email, iterations) for iterations in config.identifier_legacy_iterations
+        if iterations != config.identifier_iterations
+    ]
 
 
 def make_password(raw_password: str) -> str:
-    chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
-    algorithm = 'sha256'
-    iterations = 216000
-    salt: str = ''.join(secrets.choice(chars) for i in range(12))
-    hash_b64: str = password_hash(algorithm, raw_password, salt, iterations)
-    return f'pbkdf2_{algorithm}${iterations}${salt}${hash_b64}'
+    return hashers.make_password(raw_password, config.password_hasher, config.password_hasher_params)
 
 
 def check_password(raw_password: str, encrypted_password: str) -> bool:
-    algorithm, iterations, salt, hash_b64 = encrypted_password.split('$')
-    algorithm = algorithm.split('_')[-1]
-    iterations = int(iterations)
-    return password_hash(algorithm, raw_password, salt, iterations) == hash_b64
+    return hashers.check_password(raw_password, encrypted_password)
+
+
+def password_must_update(encrypted_password: str) -> bool:
+    return hashers.must_update(encrypted_password, config.password_hasher, config.password_hasher_params)
 
 
 def get_private_key(key_file):
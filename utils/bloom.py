@@ -0,0 +1,126 @@
+import hashlib
+import math
+import time
+from typing import Optional, Callable, Awaitable
+
+from aiocache import caches
+
+cache = caches.get('default')
+
+# missing log entries are waited for this long before being treated as lost
+GAP_TIMEOUT = 5
+
+
+class BloomFilter:
+    """
+    布隆过滤器，不在其中的元素一定未被添加过
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def clear(self):
+        self.bits = bytearray(len(self.bits))
+
+
+class SharedBloomFilter:
+    """
+    进程内布隆过滤器，通过共享缓存中的追加日志获取其他进程添加的元素
+    日志条目缺失时（写入中或已过期）无法排除任何元素，might_contain 返回 True
+    """
+
+    def __init__(self, name: str, capacity: int, error_rate: float = 0.01, sync_interval: float = 1,
+                 log_ttl: Optional[int] = 86400):
+        self.name = name
+        self.local = BloomFilter(capacity, error_rate)
+        self.sync_interval = sync_interval
+        self.log_ttl = log_ttl
+        self.seq = 0
+        self.synced_at = 0.0
+        self.gap_since: Optional[float] = None
+        # called when log entries are lost, should rebuild the filter
+        self.on_lost: Optional[Callable[[], Awaitable[None]]] = None
+
+    @property
+    def seq_key(self) -> str:
+        return f'{self.name}-seq'
+
+    async def current_seq(self) -> int:
+        return int(await cache.get(self.seq_key) or 0)
+
+    def reset(self, seq: int):
+        """
+        重建前调用，seq 之前的元素由调用者添加
+        """
+        self.local.clear()
+        self.seq = seq
+        self.gap_since = None
+
+    async def add(self, item: str):
+        self.local.add(item)
+        seq = await cache.increment(self.seq_key)
+        await cache.set(f'{self.name}-{seq}', item, ttl=self.log_ttl)
+
+    async def _lost(self, seq: int):
+        self.seq = seq
+        self.gap_since = None
+        if self.on_lost:
+            await self.on_lost()
+
+    async def sync(self) -> bool:
+        """
+        Returns:
+            False if entries added by other processes are lost
+        """
+        self.synced_at = time.monotonic()
+        seq = await self.current_seq()
+        if seq < self.seq:  # shared cache flushed, the entries added since the last sync are gone
+            await self._lost(seq)
+            return False
+        missing = None
+        for start in range(self.seq + 1, seq + 1, 1000):
+            end = min(start + 1000, seq + 1)
+            items = await cache.multi_get([f'{self.name}-{i}' for i in range(start, end)])
+            for i, item in zip(range(start, end), items):
+                if item is None:
+                    missing = i if missing is None else missing
+                else:
+                    self.local.add(item)
+
+        if missing is None:
+            self.seq = seq
+            self.gap_since = None
+            return True
+        if self.gap_since is None:
+            self.gap_since = time.monotonic()
+        if time.monotonic() - self.gap_since > GAP_TIMEOUT:
+            await self._lost(seq)
+            return False
+        self.seq = missing - 1
+        return True
+
+    async def might_contain(self, item: str) -> bool:
+        if item in self.local:
+            return True
+        if time.monotonic() - self.synced_at >= self.sync_interval:
+            if not await self.sync():
+                return True
+            if item in self.local:
+                return True
+        return self.gap_since is not None
@@ -0,0 +1,83 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from aiocache import caches
+
+cache = caches.get('default')
+
+MISSING = object()
+
+
+class LRUCache:
+    """
+    进程内的 LRU 缓存，ttl 为 None 时不过期
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self.data.get(key, MISSING)
+        if item is MISSING:
+            return default
+        expires, value = item
+        if expires and expires < time.monotonic():
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        expires = time.monotonic() + self.ttl if self.ttl else 0
+        self.data[key] = (expires, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key: Hashable):
+        return self.get(key, MISSING) is not MISSING
+
+
+class TieredCache:
+    """
+    共享缓存（生产环境为 redis），不启用时退化为进程内 LRU 缓存
+    其他进程无法使进程内缓存失效，启用共享缓存时不再缓存在进程内，删除对所有进程立即生效
+    共享缓存中的值需能被 json 序列化
+    """
+
+    def __init__(self, namespace: str, maxsize: int = 1024, ttl: float = 60, remote_ttl: Optional[int] = None,
+                 remote: bool = True):
+        self.namespace = namespace
+        self.local = LRUCache(maxsize, ttl)
+        self.remote_ttl = remote_ttl
+        self.remote = remote
+
+    async def get(self, key: Hashable, default: Any = None) -> Any:
+        if not self.remote:
+            return self.local.get(key, default)
+        value = await cache.get(str(key), namespace=self.namespace)
+        return default if value is None else value
+
+    async def set(self, key: Hashable, value: Any):
+        if not self.remote:
+            self.local.set(key, value)
+            return
+        await cache.set(str(key), value, ttl=self.remote_ttl, namespace=self.namespace)
+
+    async def delete(self, key: Hashable):
+        if not self.remote:
+            self.local.delete(key)
+            return
+        await cache.delete(str(key), namespace=self.namespace)
@@ -7,8 +7,8 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 from config import config
 from models import User
-from utils.exceptions import Unauthorized
-from utils.jwt_utils import decode_payload
+from utils.exceptions import Unauthorized, NotFound
+from utils.jwt_utils import verify_token
 from utils.orm import get_object_or_404
 
 token_scheme = HTTPBearer(auto_error=False)
@@ -25,6 +25,16 @@ def get_user_id(x_consumer_username: str = Header(default='')) -> int:
 
 
 async def get_user(id: int = Depends(get_user_id)) -> User:
+    """
+    从缓存读取，只读；需要修改或读取其他字段时用 get_user_from_db
+    """
+    user = await User.get_cached(id)
+    if not user:
+        raise NotFound('User does not exist')
+    return user
+
+
+async def get_user_from_db(id: int = Depends(get_user_id)) -> User:
     return await get_object_or_404(User, id=id)
 
 
@@ -36,8 +46,8 @@ async def get_user_by_refresh_token(token: Optional[HTTPAuthorizationCredentials
         return user
     if not token:
         raise Unauthorized('Bearer token required')
-    payload = decode_payload(token.credentials)
-    if not payload or payload.get('type') != 'refresh':
+    payload = await verify_token(token.credentials, 'refresh')
+    if not payload:
         raise Unauthorized('refresh token invalid')
     return await get_object_or_404(User, id=payload.get('uid'))
 
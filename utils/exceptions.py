@@ -37,6 +37,11 @@ class ServerError(HTTPException):
         super().__init__(500, message)
 
 
+class ServiceUnavailable(HTTPException):
+    def __init__(self, message: str = 'Service Unavailable'):
+        super().__init__(503, message)
+
+
 @app.exception_handler(IntegrityError)
 async def integrity_error_handler(request, exception: IntegrityError):
     raise BadRequest(str(exception))
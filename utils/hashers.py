@@ -0,0 +1,188 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from typing import Dict, Type
+
+# 仅依赖标准库，便于在进程池中执行
+
+SALT_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+
+class BasePasswordHasher:
+    """
+    密码哈希算法，存储格式为 {algorithm}${params...}${salt}${hash}
+    """
+    algorithm = ''
+
+    def __init__(self, **params):
+        self.params = params
+
+    @staticmethod
+    def salt() -> str:
+        return ''.join(secrets.choice(SALT_CHARS) for i in range(12))
+
+    def encode(self, raw_password: str, salt: str) -> str:
+        raise NotImplementedError
+
+    def decode(self, encrypted_password: str) -> dict:
+        """
+        解析存储的密码，返回 params 与 salt
+        """
+        raise NotImplementedError
+
+    def verify(self, raw_password: str, encrypted_password: str) -> bool:
+        decoded = self.decode(encrypted_password)
+        salt = decoded.pop('salt')
+        encoded = type(self)(**decoded).encode(raw_password, salt)
+        return hmac.compare_digest(encoded.encode(), encrypted_password.encode())
+
+    def must_update(self, encrypted_password: str) -> bool:
+        decoded = self.decode(encrypted_password)
+        decoded.pop('salt')
+        return decoded != self.params
+
+    def scale(self, factor: float) -> dict:
+        """
+        返回代价约为当前 factor 倍的参数
+        """
+        raise NotImplementedError
+
+
+hashers: Dict[str, Type[BasePasswordHasher]] = {}
+
+
+def register_hasher(cls: Type[BasePasswordHasher]) -> Type[BasePasswordHasher]:
+    hashers[cls.algorithm] = cls
+    return cls
+
+
+@register_hasher
+class PBKDF2SHA256Hasher(BasePasswordHasher):
+    algorithm = 'pbkdf2_sha256'
+
+    def __init__(self, iterations: int = 216000):
+        super().__init__(iterations=iterations)
+
+    def encode(self, raw_password: str, salt: str) -> str:
+        iterations = self.params['iterations']
+        hash_b64 = base64.b64encode(
+            hashlib.pbkdf2_hmac('sha256', raw_password.encode(), salt.encode(), iterations)
+        ).decode()
+        return f'{self.algorithm}${iterations}${salt}${hash_b64}'
+
+    def decode(self, encrypted_password: str) -> dict:
+        algorithm, iterations, salt, hash_b64 = encrypted_password.split('$')
+        return {'iterations': int(iterations), 'salt': salt}
+
+    def scale(self, factor: float) -> dict:
+        return {'iterations': max(int(self.params['iterations'] * factor), 1000)}
+
+
+@register_hasher
+class ScryptHasher(BasePasswordHasher):
+    algorithm = 'scrypt'
+
+    def __init__(self, n: int = 2 ** 14, r: int = 8, p: int = 1):
+        super().__init__(n=n, r=r, p=p)
+
+    def encode(self, raw_password: str, salt: str) -> str:
+        n, r, p = self.params['n'], self.params['r'], self.params['p']
+        hash_b64 = base64.b64encode(hashlib.scrypt(
+            raw_password.encode(), salt=salt.encode(), n=n, r=r, p=p,
+            maxmem=256 * n * r * p, dklen=32
+        )).decode()
+        return f'{self.algorithm}${n}${r}${p}${salt}${hash_b64}'
+
+    def decode(self, encrypted_password: str) -> dict:
+        algorithm, n, r, p, salt, hash_b64 = encrypted_password.split('$')
+        return {'n': int(n), 'r': int(r), 'p': int(p), 'salt': salt}
+
+    def scale(self, factor: float) -> dict:
+        # n must be a power of 2
+        n = self.params['n']
+        while factor >= 2:
+            n *= 2
+            factor /= 2
+        while factor < 0.5 and n > 2 ** 10:
+            n //= 2
+            factor *= 2
+        return {**self.params, 'n': n}
+
+
+def get_hasher(algorithm: str, params: dict = None) -> BasePasswordHasher:
+    try:
+        cls = hashers[algorithm]
+    except KeyError:
+        raise ValueError(f'unknown password hasher {algorithm}')
+    return cls(**(params or {}))
+
+
+def identify_hasher(encrypted_password: str) -> BasePasswordHasher:
+    return get_hasher(encrypted_password.split('$', 1)[0])
+
+
+def make_password(raw_password: str, algorithm: str, params: dict = None) -> str:
+    hasher = get_hasher(algorithm, params)
+    return hasher.encode(raw_password, hasher.salt())
+
+
+def check_password(raw_password: str, encrypted_password: str) -> bool:
+    return identify_hasher(encrypted_password).verify(raw_password, encrypted_password)
+
+
+def must_update(encrypted_password: str, algorithm: str, params: dict = None) -> bool:
+    """
+    存储的密码算法或参数与当前配置不一致时，需要重新计算哈希
+    """
+    if encrypted_password.split('$', 1)[0] != algorithm:
+        return True
+    return get_hasher(algorithm, params).must_update(encrypted_password)
+
+
+def benchmark(hasher: BasePasswordHasher, rounds: int = 3) -> float:
+    encrypted = hasher.encode('password', hasher.salt())
+    best = float('inf')
+    for i in range(rounds):
+        start = time.perf_counter()
+        hasher.verify('password', encrypted)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def calibrate(algorithm: str, target: float) -> dict:
+    """
+    在本机上测试，选择单次校验耗时接近 target 秒的参数
+    """
+    hasher = get_hasher(algorithm)
+    for i in range(8):
+        elapsed = benchmark(hasher)
+        factor = target / elapsed
+        if 0.9 <= factor <= 1.1:
+            break
+        params = hasher.scale(factor)
+        if params == hasher.params:
+            break
+        hasher = get_hasher(algorithm, params)
+    return hasher.params
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='calibrate password hashing cost on this host')
+    parser.add_argument('--algorithm', '-a', type=str, default='pbkdf2_sha256', choices=list(hashers))
+    parser.add_argument('--target', '-t', type=float, default=100,
+                        help='target verification latency in milliseconds')
+    args = parser.parse_args()
+
+    params = calibrate(args.algorithm, args.target / 1000)
+    elapsed = benchmark(get_hasher(args.algorithm, params))
+    # cpus available to this process, respecting container limits
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    print(f'verification latency: {elapsed * 1000:.1f} ms')
+    print(f'estimated throughput: {cores / elapsed:.0f} logins/s with {cores} cores')
+    print(f'PASSWORD_HASHER={args.algorithm}')
+    print(f"PASSWORD_HASHER_PARAMS='{json.dumps(params)}'")
@@ -2,11 +2,16 @@ from datetime import datetime, timezone, timedelta
 from typing import Tuple, Optional
 
 import jwt
-from jwt import DecodeError
+from jwt import DecodeError, PyJWTError
 
+from config import config
 from models import User
-from utils.kong import get_jwt_credential, JwtCredential, get_acls
+from utils import last_login
+from utils.keyring import keyring
+from utils.kong import get_jwt_credential, JwtCredential, find_jwt_credential
+from utils.cache import LRUCache
 from utils.orm import serialize, models_creator
+from utils.revocation import is_revoked
 from utils.values import now
 
 
@@ -20,47 +25,90 @@ def decode_payload(token: str) -> Optional[dict]:
         return
 
 
-def verify_token(token: str, token_type='access') -> Optional[dict]:
+# users without a jwt credential, so that revoked or forged tokens do not reach kong
+missing_credentials = LRUCache(config.credential_cache_size, config.credential_missing_ttl)
+
+
+async def find_credential(user_id: int) -> Optional[JwtCredential]:
+    if user_id in missing_credentials:
+        return None
+    credential = await find_jwt_credential(user_id)
+    if credential is None:
+        missing_credentials.set(user_id, True)
+    return credential
+
+
+async def verify_token(token: str, token_type='access') -> Optional[dict]:
     """
-    连接 API 网关查询 token 是否有效
+    在本地校验 token 的签名、有效期与吊销状态，返回 payload
     """
-    pass
+    payload = decode_payload(token)
+    if not payload or payload.get('type') != token_type or not isinstance(payload.get('uid'), int):
+        return
+    # only rejects, safe before the signature is checked
+    if await is_revoked(payload):
+        return
+    if config.jwt_mode == 'local':
+        return keyring.verify(token)
+    credential = await find_credential(payload['uid'])
+    if credential is None or credential.key != payload.get('iss'):
+        return
+    try:
+        return jwt.decode(token, credential.secret, algorithms=[credential.algorithm])
+    except PyJWTError:
+        return
 
 
-def create_access_token(payload: dict, credential: JwtCredential) -> str:
+def encode(payload: dict, credential: Optional[JwtCredential] = None) -> str:
+    """
+    没有 credential 时使用本地密钥签名
+    """
+    if credential is None:
+        return keyring.sign(payload)
+    return jwt.encode(payload, credential.secret, algorithm=credential.algorithm)
+
+
+def create_access_token(payload: dict, credential: Optional[JwtCredential] = None) -> str:
     payload['type'] = 'access'
     payload['exp'] = payload['iat'] + timedelta(minutes=30)
-    return jwt.encode(payload, credential.secret, algorithm=credential.algorithm)
+    return encode(payload, credential)
 
 
-def create_refresh_token(payload: dict, credential: JwtCredential) -> str:
+def create_refresh_token(payload: dict, credential: Optional[JwtCredential] = None) -> str:
     payload['type'] = 'refresh'
     payload['exp'] = payload['iat'] + timedelta(days=30)
-    return jwt.encode(payload, credential.secret, algorithm=credential.algorithm)
+    return encode(payload, credential)
 
 
 JWTUser, _ = models_creator(User, exclude=('joined_time', 'last_login'))
 
 
-async def create_tokens(user: User) -> Tuple[str, str]:
+async def create_tokens(user: User, refresh: bool = False) -> Tuple[str, str]:
     """
     Args:
         user: User
+        refresh: issued for a verified refresh token, the cached credential could be used
 
     Returns:
         access_token, refresh_token
 
     """
     user.last_login = now()
-    user.roles = await get_acls(user.id)
-    await user.save()
-
-    credential = await get_jwt_credential(user.id)
+    last_login.record(user.id, user.last_login)
+
+    if config.jwt_mode == 'local':
+        credential = None
+        issuer = config.jwt_issuer
+    else:
+        credential = await get_jwt_credential(user.id, cached=refresh)
+        missing_credentials.delete(user.id)
+        issuer = credential.key
     payload = {
         'uid': user.id,
-        'iss': credential.key,
+        'iss': issuer,
         'iat': datetime.now(tz=timezone.utc),
     }
+    # roles come from the database, the outbox brings the kong acls in line with them
     payload.update(await serialize(user, JWTUser))
 
     return create_access_token(payload, credential), create_refresh_token(payload, credential)
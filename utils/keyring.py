@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import secrets
+import time
+from typing import Optional
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ed25519
+from jwt import PyJWTError
+from jwt.algorithms import RSAAlgorithm, OKPAlgorithm
+
+from config import config
+
+
+class KeyRing:
+    """
+    本地 JWT 签名密钥，目录下每个 {kid}.pem 为一个私钥
+    最新的密钥用于签名，所有密钥的公钥都在 JWKS 中公开，以便轮换期间旧 token 仍可校验
+    """
+
+    def __init__(self, path: str, algorithm: str = 'RS256', count: int = 3):
+        if algorithm not in ('RS256', 'EdDSA'):
+            raise ValueError(f'unsupported jwt algorithm {algorithm}')
+        self.path = path
+        self.algorithm = algorithm
+        self.count = count
+        self.keys: dict = {}
+        self.mtime: Optional[int] = None
+
+    def _mtime(self) -> Optional[int]:
+        # changes whenever a key file is added or removed
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        keys = {}
+        self.mtime = self._mtime()
+        if self.mtime is not None:
+            for name in sorted(os.listdir(self.path)):
+                if not name.endswith('.pem'):
+                    continue
+                try:
+                    with open(os.path.join(self.path, name), 'rb') as f:
+                        keys[name[:-4]] = serialization.load_pem_private_key(f.read(), password=None)
+                except FileNotFoundError:  # pruned by a rotation meanwhile
+                    continue
+        self.keys = keys
+
+    def reload(self):
+        """
+        密钥目录变化时重新读取，轮换对运行中的进程生效
+        """
+        if self.mtime is None or self._mtime() != self.mtime:
+            self.load()
+
+    def generate(self):
+        if self.algorithm == 'EdDSA':
+            return ed25519.Ed25519PrivateKey.generate()
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def _write(self, kid: str):
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        pem = self.generate().private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        path = os.path.join(self.path, f'{kid}.pem')
+        # written aside and linked into place, so no process reads a partial key
+        tmp = os.path.join(self.path, f'.{kid}-{secrets.token_hex(4)}.tmp')
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(pem)
+            # fails if the key exists
+            os.link(tmp, path)
+        finally:
+            os.remove(tmp)
+
+    def ensure(self, create: bool = False):
+        """
+        启动时检查签名密钥，多个副本应共享同一密钥目录，由 python -m utils.keyring rotate 预先生成
+        Args:
+            create: generate one if there is none, for debugging on a single host only
+        """
+        self.load()
+        if self.keys:
+            return
+        if not create:
+            raise RuntimeError(
+                f'no jwt signing key in {self.path}, '
+                f'run python -m utils.keyring rotate on a volume shared by all replicas'
+            )
+        self._write(self.new_kid())
+        self.load()
+
+    @staticmethod
+    def new_kid() -> str:
+        # sortable by creation time
+        return f'{time.time_ns()}-{secrets.token_hex(4)}'
+
+    def rotate(self) -> str:
+        """
+        生成新的签名密钥，只保留最新的 count 个
+        """
+        kid = self.new_kid()
+        self._write(kid)
+        self.load()
+        for old in list(self.keys)[:-self.count]:
+            os.remove(os.path.join(self.path, f'{old}.pem'))
+        self.load()
+        return kid
+
+    @property
+    def current(self) -> tuple:
+        self.reload()
+        if not self.keys:
+            raise RuntimeError(f'no jwt signing key in {self.path}, run python -m utils.keyring rotate')
+        kid = next(reversed(self.keys))
+        return kid, self.keys[kid]
+
+    def sign(self, payload: dict) -> str:
+        kid, key = self.current
+        return jwt.encode(payload, key, algorithm=self.algorithm, headers={'kid': kid})
+
+    def verify(self, token: str) -> Optional[dict]:
+        """
+        校验签名与有效期，返回 payload
+        """
+        try:
+            kid = jwt.get_unverified_header(token).get('kid')
+            self.reload()  # rotated by another process
+            key = self.keys.get(kid)
+            if key is None:
+                return
+            return jwt.decode(token, key.public_key(), algorithms=[self.algorithm])
+        except PyJWTError:
+            return
+
+    def jwks(self) -> dict:
+        self.reload()
+        keys = []
+        for kid, key in self.keys.items():
+            if self.algorithm == 'EdDSA':
+                jwk = json.loads(OKPAlgorithm.to_jwk(key.public_key()))
+            else:
+                jwk = json.loads(RSAAlgorithm.to_jwk(key.public_key()))
+            jwk.update({'kid': kid, 'alg': self.algorithm, 'use': 'sig'})
+            keys.append(jwk)
+        return {'keys': keys}
+
+
+keyring = KeyRing(config.jwt_key_path, config.jwt_algorithm, config.jwt_key_count)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='manage the local jwt signing keys')
+    parser.add_argument('action', choices=['rotate', 'list'])
+    args = parser.parse_args()
+
+    if args.action == 'rotate':
+        print(keyring.rotate())
+    else:
+        keyring.load()
+        for kid in keyring.keys:
+            print(kid)
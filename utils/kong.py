@@ -1,17 +1,22 @@
 import asyncio
-from typing import List
+from typing import List, Optional
 
-from aiohttp import ClientSession
 from pydantic import BaseModel
 
 from config import config
+from utils.cache import TieredCache
 from utils.exceptions import ServerError
+from utils.kong_client import client
 
-headers = {
-    'Authorization': config.kong_token
-} if config.kong_token else {}
-headers['Content-Type'] = 'application/json'
-kong = ClientSession(base_url=config.kong_url, headers=headers)
+# user id -> jwt credential, invalidated by delete_jwt_credentials
+# a lookup racing with a deletion may cache the deleted one again, so the ttl is short
+credential_cache = TieredCache(
+    'jwt_credential',
+    maxsize=config.credential_cache_size,
+    ttl=config.credential_cache_ttl,
+    remote_ttl=config.credential_cache_redis_ttl,
+    remote=config.credential_cache_redis
+)
 
 
 class JwtCredential(BaseModel):
@@ -22,87 +27,107 @@ class JwtCredential(BaseModel):
 
 
 async def create_user(id: int) -> dict:
-    async with kong.put(f'/consumers/{id}', json={}) as r:
-        json = await r.json(content_type=None)
-        if not r.status == 200:
-            raise ServerError(json.get('message'))
-        return json
+    status, json = await client.request('PUT', '/consumers/{id}', json={}, id=id)
+    if not status == 200:
+        raise ServerError(json.get('message'))
+    return json
 
 
 async def create_jwt_credential(id: int) -> JwtCredential:
-    async with kong.post(f'/consumers/{id}/jwt', json={}) as r:
-        json = await r.json(content_type=None)
-        if r.status == 404:  # sometimes the user is not created
-            await create_user(id)
-            return await create_jwt_credential(id)
-        if not r.status == 201:
-            raise ServerError(json.get('message'))
-        return JwtCredential(**json)
+    status, json = await client.request('POST', '/consumers/{id}/jwt', json={}, id=id)
+    if status == 404:  # sometimes the user is not created
+        await create_user(id)
+        return await create_jwt_credential(id)
+    if not status == 201:
+        raise ServerError(json.get('message'))
+    return JwtCredential(**json)
 
 
 async def list_jwt_credentials(id: int) -> List[dict]:
-    async with kong.get(f'/consumers/{id}/jwt') as r:
-        json = await r.json(content_type=None)
-        if not r.status == 200:
-            raise ServerError(json.get('message'))
-        data = json.get('data', [])
-        return data
+    status, json = await client.request('GET', '/consumers/{id}/jwt', id=id)
+    if not status == 200:
+        raise ServerError(json.get('message'))
+    data = json.get('data', [])
+    return data
 
 
-async def get_jwt_credential(id: int) -> JwtCredential:
+async def find_jwt_credential(id: int) -> Optional[JwtCredential]:
     """
-    返回用户的第一个 credential
+    返回用户的第一个 credential，不存在时返回 None
     """
+    cached = await credential_cache.get(id)
+    if cached:
+        return JwtCredential(**cached)
     data = await list_jwt_credentials(id)
     if len(data) == 0:
-        return await create_jwt_credential(id)
-    return JwtCredential(**data[0])
+        return None
+    credential = JwtCredential(**data[0])
+    await credential_cache.set(id, credential.dict())
+    return credential
+
+
+async def get_jwt_credential(id: int, cached: bool = False) -> JwtCredential:
+    """
+    返回用户的第一个 credential，不存在时创建，用于签发 token
+    默认从 kong 读取并覆盖缓存：与删除并发的查询可能把已删除的 credential 写回缓存
+    cached 仅用于 refresh，其 token 已由缓存中的 credential 校验
+    """
+    if cached:
+        credential = await find_jwt_credential(id)
+        if credential is not None:
+            return credential
+    data = await list_jwt_credentials(id)
+    if data:
+        credential = JwtCredential(**data[0])
+    else:
+        credential = await create_jwt_credential(id)
+    await credential_cache.set(id, credential.dict())
+    return credential
 
 
 async def delete_jwt_credentials(id: int) -> int:
     async def _delete_a_credential(jwt_id: int) -> bool:
-        async with kong.delete(f'/consumers/{id}/jwt/{jwt_id}') as r:
-            return r.status == 204
+        status, _ = await client.request('DELETE', '/consumers/{id}/jwt/{jwt_id}', id=id, jwt_id=jwt_id)
+        return status == 204
 
     data = await list_jwt_credentials(id)
     tasks = []
     for i in data:
         tasks.append(_delete_a_credential(i['id']))
     results = await asyncio.gather(*tasks)
+    await credential_cache.delete(id)
     return len(list(filter(None, results)))
 
 
 async def connect_to_gateway():
-    async with kong.get('/') as r:
-        if not r.status == 200:
-            print('Kong API gateway unreachable!')
-        else:
-            print('gateway connected')
+    status, _ = await client.request('GET', '/')
+    if not status == 200:
+        print('Kong API gateway unreachable!')
+    else:
+        print('gateway connected')
 
 
 async def get_acls(id: int) -> List[str]:
-    async with kong.get(f'/consumers/{id}/acls') as r:
-        json = await r.json(content_type=None)
-        if not r.status == 200:
-            raise ServerError(json.get('message'))
-        data = [acl['group'] for acl in json['data']]
-        data.sort()
-        return data
+    status, json = await client.request('GET', '/consumers/{id}/acls', id=id)
+    if not status == 200:
+        raise ServerError(json.get('message'))
+    data = [acl['group'] for acl in json['data']]
+    data.sort()
+    return data
 
 
 async def add_acl(id: int, group: str) -> bool:
-    async with kong.post(f'/consumers/{id}/acls', json={
+    # conflict is treated as success, so it is safe to retry
+    status, json = await client.request('POST', '/consumers/{id}/acls', json={
         'group': group
-    }) as r:
-        if not (r.status == 201 or r.status == 409):
-            json = await r.json(content_type=None)
-            raise ServerError(json.get('message'))
-        return True
+    }, idempotent=True, id=id)
+    if not (status == 201 or status == 409):
+        raise ServerError(json.get('message'))
+    return True
 
 
 async def delete_acl(id: int, group: str) -> bool:
-    async with kong.delete(f'/consumers/{id}/acls/{group}', json={}) as r:
-        if not (r.status == 204 or r.status == 404):
-            json = await r.json(content_type=None)
-            raise ServerError(json.get('message'))
-        return True
+    status, json = await client.request('DELETE', '/consumers/{id}/acls/{group}', json={}, id=id, group=group)
+    if not (status == 204 or status == 404):
+        raise ServerError(json.get('message'))
+    return True
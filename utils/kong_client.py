@@ -0,0 +1,144 @@
+import asyncio
+import random
+import time
+from typing import Optional, Tuple
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, ClientError
+
+from config import config
+from utils.exceptions import ServiceUnavailable
+from utils.metrics import get_metric, register_gauge
+
+IDEMPOTENT_METHODS = {'GET', 'PUT', 'DELETE'}
+
+
+class CircuitBreaker:
+    """
+    连续失败 threshold 次后熔断，快速失败
+    熔断 reset_timeout 秒后放行一个试探请求，成功则恢复
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            # half open, let one request through and block the others until it finishes
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+class KongClient:
+    """
+    Kong admin API 客户端，连接池随应用启动和关闭
+    """
+
+    def __init__(self):
+        headers = {
+            'Authorization': config.kong_token
+        } if config.kong_token else {}
+        headers['Content-Type'] = 'application/json'
+        self.headers = headers
+        self.session: Optional[ClientSession] = None
+        self.breaker = CircuitBreaker(config.kong_breaker_threshold, config.kong_breaker_reset)
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            self.session = ClientSession(
+                base_url=config.kong_url,
+                headers=self.headers,
+                connector=TCPConnector(limit=config.kong_pool_size, keepalive_timeout=config.kong_keepalive),
+                timeout=ClientTimeout(total=config.kong_timeout)
+            )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def request(
+            self,
+            method: str,
+            endpoint: str,
+            json: Optional[dict] = None,
+            timeout: Optional[float] = None,
+            idempotent: Optional[bool] = None,
+            **params
+    ) -> Tuple[int, dict]:
+        """
+        Args:
+            method: http method
+            endpoint: path template, e.g. /consumers/{id}/jwt, used as the metric name
+            json: request body
+            timeout: deadline of the whole call in seconds, including retries
+            idempotent: whether the call could be retried, default by method
+            **params: path params
+
+        Returns:
+            status, json body
+        """
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        attempts = config.kong_retries + 1 if idempotent else 1
+        deadline = time.monotonic() + (timeout or config.kong_timeout)
+        metric = get_metric(f'kong.{method} {endpoint}')
+        path = endpoint.format(**params)
+
+        await self.start()
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                metric.error()
+                raise ServiceUnavailable('API gateway unavailable')
+            start = time.monotonic()
+            try:
+                async with self.session.request(
+                        method, path, json=json,
+                        timeout=ClientTimeout(total=max(deadline - start, 0.001))
+                ) as r:
+                    status = r.status
+                    try:
+                        data = await r.json(content_type=None) or {}
+                    except ValueError:
+                        data = {}
+            except (ClientError, asyncio.TimeoutError):
+                status, data = 0, {}
+            metric.observe(time.monotonic() - start)
+
+            if 0 < status < 500:
+                self.breaker.success()
+                return status, data
+            metric.error()
+            self.breaker.failure()
+            # full jitter backoff
+            backoff = random.uniform(0, config.kong_retry_backoff * 2 ** attempt)
+            if attempt + 1 == attempts or time.monotonic() + backoff >= deadline:
+                break
+            await asyncio.sleep(backoff)
+
+        if status == 0:
+            raise ServiceUnavailable('API gateway unavailable')
+        return status, data
+
+
+client = KongClient()
+
+register_gauge('kong.breaker_open', lambda: int(client.breaker.is_open))
@@ -0,0 +1,65 @@
+import asyncio
+from datetime import datetime
+from typing import Optional
+
+from config import config
+from models import User
+from utils.metrics import get_metric, register_gauge
+
+# user id -> last login time, not written yet
+pending: dict[int, datetime] = {}
+task: Optional[asyncio.Task] = None
+
+register_gauge('last_login.pending', lambda: len(pending))
+
+
+def record(user_id: int, time: datetime):
+    """
+    记录登录时间，定期批量写入数据库，同一用户多次登录只写入最后一次
+    """
+    pending[user_id] = time
+
+
+async def flush() -> int:
+    global pending
+    if not pending:
+        return 0
+    logins, pending = pending, {}
+    users = [User(id=user_id, last_login=time) for user_id, time in logins.items()]
+    try:
+        await User.bulk_update(users, fields=['last_login'], batch_size=config.last_login_batch_size)
+    except Exception:
+        # keep the newer ones recorded in the meantime
+        for user_id, time in logins.items():
+            pending.setdefault(user_id, time)
+        get_metric('last_login.flush').error()
+        raise
+    await User.invalidate_cache(*logins)
+    get_metric('last_login.flush').observe(len(users))
+    return len(users)
+
+
+async def run():
+    while True:
+        await asyncio.sleep(config.last_login_flush_interval)
+        try:
+            await flush()
+        except Exception as e:
+            print(f'flush last login failed: {e}')
+
+
+def start():
+    global task
+    if task is None:
+        task = asyncio.create_task(run())
+
+
+async def stop():
+    global task
+    if task is not None:
+        task.cancel()
+        task = None
+    try:
+        await flush()
+    except Exception as e:
+        print(f'flush last login failed: {e}')
@@ -0,0 +1,119 @@
+import asyncio
+import os
+import secrets
+import socket
+import time
+from typing import Optional, Callable, Awaitable, List
+
+from aiocache import caches, RedisCache
+
+from config import config
+from utils.metrics import register_gauge
+
+cache = caches.get('default')
+
+EXTEND_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class Lease:
+    """
+    基于共享缓存（生产环境为 redis）的租约，在多个进程中选出一个 leader
+    leader 定期续约，失联超过 ttl 后由其他进程接替
+    调试模式下共享缓存在进程内存中，每个进程都是 leader
+    """
+
+    def __init__(self, name: str, ttl: int = 30, heartbeat: float = 10):
+        self.key = f'lease-{name}'
+        self.owner = f'{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(4)}'
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.elected = False
+        self.expires = 0.0  # monotonic time, the lease may be taken over after it
+        self.task: Optional[asyncio.Task] = None
+        # called after becoming the leader
+        self.on_elected: List[Callable[[], Awaitable]] = []
+
+    @property
+    def is_leader(self) -> bool:
+        # stop leading once the lease may have expired, even if the heartbeat is late
+        return self.elected and time.monotonic() < self.expires
+
+    async def _if_owner(self, script: str, command: Callable[[], Awaitable]) -> bool:
+        """
+        租约仍属于本进程时执行，在 redis 中以脚本原子地完成检查与执行
+        """
+        if isinstance(cache, RedisCache):
+            return bool(await cache.raw(
+                'eval', script, keys=[self.key], args=[cache.serializer.dumps(self.owner), self.ttl]
+            ))
+        # in-process cache, nothing runs in between
+        if await cache.get(self.key) != self.owner:
+            return False
+        await command()
+        return True
+
+    async def extend(self) -> bool:
+        return await self._if_owner(EXTEND_SCRIPT, lambda: cache.expire(self.key, self.ttl))
+
+    async def acquire(self) -> bool:
+        start = time.monotonic()
+        try:
+            if not await self.extend():
+                # add fails if the key exists
+                await cache.add(self.key, self.owner, ttl=self.ttl)
+            elected = True
+        except ValueError:
+            elected = False
+        except Exception as e:
+            print(f'lease {self.key} heartbeat failed: {e}')
+            elected = False
+
+        was_leader = self.is_leader
+        self.elected = elected
+        self.expires = start + self.ttl
+        if elected and not was_leader:
+            print(f'{self.owner} is elected as the leader of {self.key}')
+            for callback in self.on_elected:
+                try:
+                    await callback()
+                except Exception as e:
+                    print(f'lease {self.key} elected callback failed: {e}')
+        return elected
+
+    async def release(self):
+        if self.is_leader:
+            await self._if_owner(RELEASE_SCRIPT, lambda: cache.delete(self.key))
+        self.elected = False
+
+    async def run(self):
+        while True:
+            await self.acquire()
+            await asyncio.sleep(self.heartbeat)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.release()
+
+
+# leader of the background jobs
+leader = Lease('scheduler', ttl=config.lease_ttl, heartbeat=config.lease_heartbeat)
+
+register_gauge('lease.leader', lambda: int(leader.is_leader))
@@ -0,0 +1,51 @@
+from collections import defaultdict
+from typing import Callable, Dict
+
+
+class Metric:
+    """
+    计数与耗时统计
+    """
+    __slots__ = ('count', 'errors', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float = 0.0):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def error(self):
+        self.errors += 1
+
+    def dict(self) -> dict:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max
+        }
+
+
+metrics: Dict[str, Metric] = defaultdict(Metric)
+gauges: Dict[str, Callable[[], float]] = {}
+
+
+def get_metric(name: str) -> Metric:
+    return metrics[name]
+
+
+def register_gauge(name: str, func: Callable[[], float]):
+    gauges[name] = func
+
+
+def snapshot() -> dict:
+    return {
+        'metrics': {name: metric.dict() for name, metric in metrics.items()},
+        'gauges': {name: func() for name, func in gauges.items()}
+    }
@@ -1,14 +1,19 @@
-from base64 import b32encode
+import json
+from base64 import b32encode, urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
 from hashlib import sha3_224
-from typing import Optional
+from typing import Optional, List, Sequence, AsyncIterator
 from typing import Type, Tuple, Union
 
+import orjson
+from starlette.responses import Response
 from tortoise import Model
+from tortoise.expressions import Q
 from tortoise.contrib.pydantic import PydanticModel, PydanticListModel, pydantic_model_creator, \
     pydantic_queryset_creator
 from tortoise.queryset import MODEL, QuerySet
 
-from utils.exceptions import NotFound
+from utils.exceptions import NotFound, BadRequest
 
 
 async def get_object_or_404(cls: Type[MODEL], *args, **kwargs) -> MODEL:
@@ -24,6 +29,66 @@ async def exists_or_404(cls: Type[MODEL], *args, **kwargs) -> bool:
     return True
 
 
+def encode_cursor(values: Sequence) -> str:
+    data = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values], separators=(',', ':'))
+    return urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, cls: Type[Model], ordering: Sequence[str]) -> list:
+    try:
+        values = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(ordering):
+            raise ValueError
+        return [cls._meta.fields_map[key].to_python_value(value) for key, value in zip(ordering, values)]
+    except (ValueError, TypeError):
+        raise BadRequest('invalid cursor')
+
+
+async def paginate(
+        queryset: QuerySet[MODEL],
+        response: Response,
+        size: int,
+        cursor: Optional[str] = None,
+        offset: int = 0,
+        ordering: Sequence[str] = ('id',)
+) -> List[MODEL]:
+    """
+    按 ordering 做 keyset 分页，ordering 须唯一且有索引
+    下一页的游标放在 X-Next-Cursor 响应头中，没有下一页时不返回
+    """
+    queryset = queryset.order_by(*ordering)
+    if cursor:
+        values = decode_cursor(cursor, queryset.model, ordering)
+        # (a, b) > (x, y)  <=>  a > x or (a = x and b > y)
+        conditions = []
+        for i, key in enumerate(ordering):
+            equal = {k: v for k, v in zip(ordering[:i], values[:i])}
+            conditions.append(Q(**equal, **{f'{key}__gt': values[i]}))
+        queryset = queryset.filter(Q(*conditions, join_type=Q.OR))
+    elif offset:
+        queryset = queryset.offset(offset)
+
+    items = await queryset.limit(size)
+    if len(items) == size:
+        response.headers['X-Next-Cursor'] = encode_cursor([getattr(items[-1], key) for key in ordering])
+    return items
+
+
+async def export_ndjson(queryset: QuerySet, fields: Sequence[str], chunk_size: int) -> AsyncIterator[bytes]:
+    """
+    按 id 分批读取，每行序列化为一行 json，不创建模型实例
+    """
+    last_id = 0
+    while True:
+        rows = await queryset.filter(id__gt=last_id).order_by('id').limit(chunk_size).values(*fields)
+        if not rows:
+            return
+        last_id = rows[-1]['id']
+        yield b''.join(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE) for row in rows)
+        if len(rows) < chunk_size:
+            return
+
+
 def models_creator(cls: Type[Model], **kwargs) -> Tuple[Type[PydanticModel], Type[PydanticListModel]]:
     return pmc(cls, **kwargs), pqc(cls, **kwargs)
 
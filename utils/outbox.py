@@ -0,0 +1,133 @@
+import asyncio
+from collections import defaultdict
+from datetime import timedelta
+from typing import Optional, Iterable, Tuple
+
+from tortoise import BaseDBAsyncClient
+
+from config import config
+from models import KongOutbox
+from utils import kong
+from utils.lease import leader
+from utils.metrics import get_metric, register_gauge
+from utils.values import now
+
+task: Optional[asyncio.Task] = None
+wakeup: Optional[asyncio.Event] = None
+status = {'pending': 0, 'lag': 0.0}
+
+register_gauge('outbox.pending', lambda: status['pending'])
+register_gauge('outbox.lag', lambda: status['lag'])
+
+
+async def enqueue(user_id: int, name: str, action: str, using_db: Optional[BaseDBAsyncClient] = None):
+    """
+    记录一条 ACL 变更，应与数据库修改在同一事务中调用，提交后调用 notify
+    同一用户同一权限未发送的旧变更会被覆盖
+    """
+    await enqueue_many([(user_id, name, action)], using_db=using_db)
+
+
+async def enqueue_many(changes: Iterable[Tuple[int, str, str]], using_db: Optional[BaseDBAsyncClient] = None):
+    """
+    批量记录 (user_id, name, action)
+    """
+    changes = list(changes)
+    by_name = defaultdict(list)
+    for user_id, name, _ in changes:
+        by_name[name].append(user_id)
+    for name, user_ids in by_name.items():
+        await KongOutbox.filter(consumer_id__in=user_ids, name=name).using_db(using_db).delete()
+    await KongOutbox.all().using_db(using_db).bulk_create([
+        KongOutbox(consumer_id=user_id, name=name, action=action) for user_id, name, action in changes
+    ])
+
+
+def notify():
+    start()
+    wakeup.set()
+
+
+async def _send(row: KongOutbox, semaphore: asyncio.Semaphore) -> bool:
+    async with semaphore:
+        try:
+            if row.action == 'add':
+                await kong.add_acl(row.consumer_id, row.name)
+            else:
+                await kong.delete_acl(row.consumer_id, row.name)
+            return True
+        except Exception as e:
+            print(f'outbox: {row.action} acl {row.name} of user {row.consumer_id} failed: {e}')
+            return False
+
+
+async def dispatch() -> int:
+    """
+    发送一批到期的变更，返回本批条数
+    """
+    rows = await KongOutbox.filter(next_try__lte=now()).order_by('id').limit(config.outbox_batch_size)
+
+    # coalesce, the latest change of a permission wins
+    latest = {}
+    for row in rows:
+        latest[(row.consumer_id, row.name)] = row
+    superseded = [row.id for row in rows if latest[(row.consumer_id, row.name)] is not row]
+
+    semaphore = asyncio.Semaphore(config.outbox_concurrency)
+    sending = list(latest.values())
+    results = await asyncio.gather(*[_send(row, semaphore) for row in sending])
+
+    done = superseded
+    failed = []
+    for row, success in zip(sending, results):
+        if success:
+            done.append(row.id)
+        else:
+            row.attempts += 1
+            row.next_try = now() + timedelta(seconds=min(2 ** row.attempts, config.outbox_max_backoff))
+            failed.append(row)
+    if done:
+        await KongOutbox.filter(id__in=done).delete()
+    if failed:
+        await KongOutbox.bulk_update(failed, fields=['attempts', 'next_try'])
+    get_metric('outbox.sent').observe(len(done))
+    if failed:
+        get_metric('outbox.sent').error()
+
+    status['pending'] = await KongOutbox.all().count()
+    oldest = await KongOutbox.all().order_by('id').first()
+    status['lag'] = (now() - oldest.created_at).total_seconds() if oldest else 0.0
+    return len(rows)
+
+
+async def run():
+    while True:
+        wakeup.clear()
+        count = 0
+        # only the leader dispatches, so changes of a permission are sent in order
+        if leader.is_leader:
+            try:
+                count = await dispatch()
+            except Exception as e:
+                print(f'outbox dispatch failed: {e}')
+        if count >= config.outbox_batch_size:
+            continue
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout=config.outbox_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start():
+    global task, wakeup
+    if task is None:
+        leader.start()
+        wakeup = asyncio.Event()
+        task = asyncio.create_task(run())
+
+
+async def stop():
+    global task
+    if task is not None:
+        task.cancel()
+        task = None
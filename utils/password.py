@@ -0,0 +1,60 @@
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Callable, Any
+
+from config import config
+from utils import hashers
+from utils.exceptions import ServiceUnavailable
+from utils.metrics import get_metric, register_gauge
+
+# 密码哈希是 CPU 密集型任务，放在进程池中计算以免阻塞事件循环
+executor: Optional[ProcessPoolExecutor] = None
+pending = 0
+
+register_gauge('password.pending', lambda: pending)
+
+
+def _timed(func: Callable, *args) -> tuple[float, Any]:
+    """
+    在子进程中执行，返回开始执行的时间以计算排队时间
+    """
+    return time.time(), func(*args)
+
+
+def start():
+    global executor
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=config.password_workers or None)
+
+
+def shutdown():
+    global executor
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = None
+
+
+async def _submit(func: Callable, *args):
+    global pending
+    if pending >= config.password_queue_size:
+        get_metric('password.rejected').observe()
+        raise ServiceUnavailable('服务繁忙，请稍后重试')
+    start()
+    pending += 1
+    submitted = time.time()
+    try:
+        started, result = await asyncio.get_running_loop().run_in_executor(executor, _timed, func, *args)
+    finally:
+        pending -= 1
+    get_metric('password.queue_wait').observe(started - submitted)
+    get_metric('password.latency').observe(time.time() - submitted)
+    return result
+
+
+async def make_password(raw_password: str) -> str:
+    return await _submit(hashers.make_password, raw_password, config.password_hasher, config.password_hasher_params)
+
+
+async def check_password(raw_password: str, encrypted_password: str) -> bool:
+    return await _submit(hashers.check_password, raw_password, encrypted_password)
@@ -0,0 +1,35 @@
+import time
+
+from aiocache import caches
+
+from config import config
+from utils.bloom import SharedBloomFilter
+
+cache = caches.get('default')
+
+REFRESH_TOKEN_LIFETIME = 30 * 86400
+
+# users that have revoked their tokens, so most lookups end in the local filter
+revoked_users = SharedBloomFilter(
+    'revoked-users',
+    capacity=config.revocation_capacity,
+    sync_interval=config.revocation_sync_interval,
+    log_ttl=REFRESH_TOKEN_LIFETIME
+)
+
+
+async def revoke_tokens(user_id: int):
+    """
+    使用户此前签发的所有 token 失效
+    """
+    await cache.set(f'revoked-{user_id}', int(time.time()), ttl=REFRESH_TOKEN_LIFETIME)
+    await revoked_users.add(str(user_id))
+
+
+async def is_revoked(payload: dict) -> bool:
+    user_id = payload.get('uid')
+    if not await revoked_users.might_contain(str(user_id)):
+        return False
+    revoked_at = await cache.get(f'revoked-{user_id}')
+    # tokens issued in the same second as the revocation are kept
+    return revoked_at is not None and payload.get('iat', 0) < revoked_at